@@ -1,5 +1,8 @@
 import csv
 
+# Make sure this file is in the same folder as the .py file
+FILE_NAME = "store_items.csv"
+
 
 def read_csv():
     ''' () -> (list, list)
@@ -224,17 +227,16 @@ def purchase_items(item, colour, items_bought):
 #########################################################################
 # Find the global code below:
 
-# Make sure this file is in the same folder as the .py file
-FILE_NAME = "store_items.csv"
-
-# Read the data just so we can see it
-csv_header, csv_data = read_csv()
-# Let's print the header of our csv file, which we are keeping separate from
-# our database, as it not a record.
-print(csv_header)
-# Now, let's print the database to see how it is set up:
-# The database is a list inside a list, which means that every item of
-# the database list represent a row
-# Every row is also represented by a list, where the order of the elements
-# is the same as the order of the database headers
-print(csv_data)
+# Only run this when the file is run, not when it is imported
+if __name__ == "__main__":
+    # Read the data just so we can see it
+    csv_header, csv_data = read_csv()
+    # Let's print the header of our csv file, which we are keeping separate from
+    # our database, as it not a record.
+    print(csv_header)
+    # Now, let's print the database to see how it is set up:
+    # The database is a list inside a list, which means that every item of
+    # the database list represent a row
+    # Every row is also represented by a list, where the order of the elements
+    # is the same as the order of the database headers
+    print(csv_data)
@@ -1,49 +1,2026 @@
+import argparse
+import bisect
+import contextlib
+import cProfile
 import csv
+import functools
+import io
+import itertools
+import json
+import locale
+import mmap
+import multiprocessing
+import os
+import pstats
+import re
+import struct
+import sys
+import time
+
+# File locks only exist on Unix, everywhere else locking mode does nothing
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Make sure this file is in the same folder as the .py file
 FILE_NAME = "store_items.csv"
 # Set the minimum stock
 MIN_STOCK = 50
+# In journal mode every change is appended to a log next to FILE_NAME
+# instead of rewriting the whole file
+JOURNAL_MODE = False
+# Fold the log back into the csv file once it has this many changes
+COMPACT_AFTER = 1000
+# In streaming mode the file is never loaded in memory: every call reads it
+# one row at a time, so it works for files bigger than the memory
+STREAMING_MODE = False
+# In locking mode many programs can change the same file at the same time:
+# every change is written while holding a lock on the file, and made again on
+# the latest data if somebody else changed the file in the meantime
+LOCKING_MODE = False
+# In in-place mode, a change that keeps its row the same length in bytes (a
+# new price or a purchase that doesn't change how many digits the number
+# has) is written over the old row, instead of writing the whole file again
+IN_PLACE_MODE = True
+# In snapshot mode read_csv keeps a binary copy of the csv file (see
+# write_snapshot), which is much faster to load than parsing the csv again
+SNAPSHOT_MODE = False
+# The first bytes of every snapshot, so we never load some other file
+SNAPSHOT_MAGIC = b"STORE\x00\x00\x01"
+# What a snapshot starts with: the magic bytes, the signature (see
+# file_signature) of the csv file it was made from, how many columns the
+# header has, how many bytes the string table has, and how many records
+# there are
+SNAPSHOT_HEADER = struct.Struct("<8sqqIII")
+# Every record of a snapshot: the number of its category, name and colour in
+# the string table, its price and its quantity
+SNAPSHOT_RECORD = struct.Struct("<IIIqq")
+# In feed mode every change is also appended, as an event, to a feed next to
+# FILE_NAME (see publish), so other programs can follow the changes
+FEED_MODE = False
+# Functions that are called with every event (see subscribe)
+SUBSCRIBERS = []
+# How wide every column of get_csv's table is, unless it sizes them itself
+COLUMN_WIDTH = 12
+# get_csv writes its table this many rows at a time
+ROWS_PER_WRITE = 1000
+
+# Files we already parsed: file name -> (signature, header, database)
+_csv_cache = {}
+# How many read_csv calls were answered from _csv_cache (hits) and how many
+# had to parse the file (misses)
+CACHE_STATS = {"hits": 0, "misses": 0}
+
+# Run a program with the environment variable STORE_STATS=1 to count how
+# many times every function of the store is called and how long it takes
+# (see get_stats). Without it, the store's functions are not touched at all.
+INSTRUMENTATION = os.environ.get("STORE_STATS", "") not in ("", "0")
+# The calls of every function are counted in buckets by how many
+# milliseconds they took: under 0.01, under 0.1, ..., and 1000 or more
+LATENCY_BUCKETS = [0.01, 0.1, 1, 10, 100, 1000]
+# function name -> {"calls": ..., "total_ms": ..., "max_ms": ...,
+# "histogram": [calls in every bucket]}
+CALL_STATS = {}
+# How many records were read from a file one by one, and how many bytes
+# were read and written
+COUNTERS = {"rows_scanned": 0, "bytes_read": 0, "bytes_written": 0}
+
+
+def timed(function):
+    ''' (function) -> function
+
+    Return function, counting its calls and how long they take in CALL_STATS
+    when INSTRUMENTATION is on. When it is off, function is given back as it
+    is, so it costs nothing.
+    '''
+    if not INSTRUMENTATION:
+        return function
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def timed_function(*arguments, **keywords):
+        started = time.perf_counter()
+        try:
+            return function(*arguments, **keywords)
+        finally:
+            took = (time.perf_counter() - started) * 1000
+            stats = CALL_STATS.get(name)
+            if stats is None:
+                stats = {"calls": 0, "total_ms": 0.0, "max_ms": 0.0,
+                         "histogram": [0] * (len(LATENCY_BUCKETS) + 1)}
+                CALL_STATS[name] = stats
+            stats["calls"] += 1
+            stats["total_ms"] += took
+            stats["max_ms"] = max(stats["max_ms"], took)
+            stats["histogram"][bisect.bisect_right(LATENCY_BUCKETS, took)] += 1
+    return timed_function
+
+
+def count(counter, amount):
+    ''' (str, int) -> NoneType
+
+    Add amount to the counter in COUNTERS, when INSTRUMENTATION is on.
+    '''
+    if INSTRUMENTATION:
+        COUNTERS[counter] += amount
+
+
+def get_stats():
+    ''' () -> dict
+
+    Return everything the store counted so far (see INSTRUMENTATION): the
+    calls of every function, the COUNTERS and the read_csv cache hits.
+    '''
+    buckets = (["<" + str(limit) + "ms" for limit in LATENCY_BUCKETS]
+               + [">=" + str(LATENCY_BUCKETS[-1]) + "ms"])
+    calls = {}
+    for name, stats in CALL_STATS.items():
+        calls[name] = {"calls": stats["calls"],
+                       "total_ms": stats["total_ms"],
+                       "mean_ms": stats["total_ms"] / stats["calls"],
+                       "max_ms": stats["max_ms"],
+                       "histogram": dict(zip(buckets, stats["histogram"]))}
+    return {"enabled": INSTRUMENTATION, "calls": calls,
+            "counters": dict(COUNTERS), "cache": get_cache_stats()}
+
+
+def save_stats(file_name):
+    ''' (str) -> NoneType
+
+    Save get_stats() as JSON in file_name.
+    '''
+    with open(file_name, 'w') as stats_file:
+        json.dump(get_stats(), stats_file, indent=2)
+
+
+def reset_stats():
+    ''' () -> NoneType
+
+    Forget everything the store counted so far.
+    '''
+    CALL_STATS.clear()
+    for counter in COUNTERS:
+        COUNTERS[counter] = 0
+    CACHE_STATS["hits"] = 0
+    CACHE_STATS["misses"] = 0
+
+
+def profile(function, *arguments, out=None, lines=20, **keywords):
+    ''' (function, ...) -> object
+
+    Call function with the arguments and keywords under cProfile, write the
+    lines functions that took the most time (counting the functions they
+    called) to out (the screen if no out is given), and return what function
+    returned. This works whether INSTRUMENTATION is on or not:
+
+    >>> profile(low_in_stock)
+    '''
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *arguments, **keywords)
+    finally:
+        stats = pstats.Stats(profiler, stream=out or sys.stdout)
+        stats.sort_stats("cumulative").print_stats(lines)
+
+
+class StoreItem:
+    ''' One record of the store's database.
+
+    The price and quantity are kept as ints, so they only need int() once,
+    when the record is read. The category, name and colour are interned:
+    records that have the same colour share a single string for it. With
+    __slots__, a record only has room for its five fields, which takes a lot
+    less memory than a list or a normal object.
+
+    A StoreItem can still be used like the old list records:
+    record[1] is the name and record[4] is the quantity.
+    '''
+
+    __slots__ = ("category", "name", "colour", "price", "quantity")
+
+    def __init__(self, category, name, colour, price, quantity):
+        ''' (StoreItem, str, str, str, int, int) -> NoneType
+
+        Create a record. The price and quantity can also be given as str.
+        '''
+        self.category = sys.intern(category)
+        self.name = sys.intern(name)
+        self.colour = sys.intern(colour)
+        self.price = int(price)
+        self.quantity = int(quantity)
+
+    def copy(self):
+        ''' (StoreItem) -> StoreItem
+
+        Return a new record with the same fields.
+        '''
+        # The fields are already interned ints and strings, so we can skip
+        # __init__ and copy them as they are
+        record = StoreItem.__new__(StoreItem)
+        record.category = self.category
+        record.name = self.name
+        record.colour = self.colour
+        record.price = self.price
+        record.quantity = self.quantity
+        return record
+
+    def key(self):
+        ''' (StoreItem) -> tuple
+
+        Return the (name, colour) that identifies the record.
+        '''
+        return (self.name, self.colour)
+
+    def __getitem__(self, index):
+        ''' (StoreItem, int) -> object
+
+        Return field number index (0 is the category, 4 the quantity).
+        '''
+        return getattr(self, StoreItem.__slots__[index])
+
+    def __setitem__(self, index, value):
+        ''' (StoreItem, int, object) -> NoneType
+
+        Replace field number index with value. Like in __init__, the price
+        and quantity can also be given as str.
+        '''
+        field = StoreItem.__slots__[index]
+        if field in ("price", "quantity"):
+            value = int(value)
+        else:
+            value = sys.intern(value)
+        setattr(self, field, value)
+
+    def __len__(self):
+        ''' (StoreItem) -> int
+
+        Return how many fields a record has.
+        '''
+        return 5
+
+    def __iter__(self):
+        ''' (StoreItem) -> iterator
+
+        Give back the fields in the order of the csv file, so a record can be
+        written with csv.writer.
+        '''
+        return iter((self.category, self.name, self.colour, self.price,
+                     self.quantity))
+
+    def __eq__(self, other):
+        ''' (StoreItem, object) -> bool
+
+        Return True if other (a StoreItem, list or tuple) has the same fields.
+        '''
+        if not isinstance(other, (StoreItem, list, tuple)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __lt__(self, other):
+        ''' (StoreItem, StoreItem) -> bool
+
+        Return True if self comes before other when records are sorted field
+        by field, like lists are.
+        '''
+        return tuple(self) < tuple(other)
+
+    def __repr__(self):
+        ''' (StoreItem) -> str
+
+        Return how to write this record in Python.
+        '''
+        return "StoreItem" + repr(tuple(self))
+
 
-def read_csv():
-    ''' () -> (list, list)
+def file_signature(file_name):
+    ''' (str) -> tuple
 
-    Given a csv file_name, open and read the file.
+    Return (modification time, size) of file_name, or None if the file does
+    not exist. If the signature did not change, neither did the file.
+    '''
+    try:
+        info = os.stat(file_name)
+    except OSError:
+        return None
+    return (info.st_mtime_ns, info.st_size)
+
+
+@timed
+def read_csv(file_name=None):
+    ''' (str) -> (list, list)
+
+    Given a csv file_name, open and read the file. If no file_name is given,
+    read FILE_NAME.
     Return header and database:
      - The header is the list of the columns' names
-     - The database is a list of lists that contains all the records.
+     - The database is a list of StoreItems that contains all the records.
+
+    The file is only parsed again if it changed since the last call. Every
+    call gets its own list, but the records in it are shared with the next
+    calls, so they must not be changed: change a copy instead (see
+    StoreItem.copy).
 
     REQ: file_name has to be a valid .csv file with a header
     '''
-    # Open the file given so we can read what's inside
-    with open(FILE_NAME) as reader_file:
-        # Read the file
-        reader = csv.reader(reader_file)
-        # Make it a list type, so it's easier for us to manage the data
-        data = list(reader)
-    # The first row of the data has the header
-    # The rest of the data are records and will be stored in the database
-    return (data[0], data[1:])
+    # If we are not told which file to read, read the store's file
+    if file_name is None:
+        file_name = FILE_NAME
+    path = os.path.abspath(file_name)
+    signature = file_signature(path)
+    cached = _csv_cache.get(path)
+    # If the file looks exactly like last time, we don't need to read it
+    if cached is not None and cached[0] == signature:
+        CACHE_STATS["hits"] += 1
+        return (list(cached[1]), list(cached[2]))
+    CACHE_STATS["misses"] += 1
+    # A snapshot made from this exact file is faster to load than the file
+    snapshot = None
+    if SNAPSHOT_MODE:
+        snapshot = read_snapshot(file_name, signature)
+    if snapshot is not None:
+        header, database = snapshot
+    else:
+        # Open the file given so we can read what's inside
+        with open(file_name) as reader_file:
+            # Read the file
+            reader = csv.reader(reader_file)
+            # The first row of the data has the header
+            header = next(reader)
+            # The rest of the data are records and will be stored in the
+            # database
+            database = [StoreItem(*row) for row in reader]
+        count("rows_scanned", len(database))
+        count("bytes_read", signature[1])
+        if SNAPSHOT_MODE:
+            write_snapshot(file_name, signature, header, database)
+    _csv_cache[path] = (signature, header, database)
+    return (list(header), list(database))
+
+
+def snapshot_name(file_name):
+    ''' (str) -> str
+
+    Return the name of the binary snapshot of the csv file_name
+    (store_items.csv -> store_items.bin).
+    '''
+    return os.path.splitext(file_name)[0] + ".bin"
+
+
+@timed
+def write_snapshot(file_name, signature, header, database):
+    ''' (str, tuple, list, list) -> bool
+
+    Write the header and database of the csv file_name, whose signature (see
+    file_signature) is signature, to its binary snapshot. Return True if the
+    snapshot was written.
+
+    A snapshot has:
+     - SNAPSHOT_HEADER
+     - the string table: every different string of the file, once, with a
+       "\0" between them
+     - the number of every column of the header in the string table
+     - one SNAPSHOT_RECORD for every record of the database
+    '''
+    # Give every different string a number, in the order we find them
+    numbers = {}
+    for column in header:
+        numbers.setdefault(column, len(numbers))
+    for record in database:
+        for field in (record[0], record[1], record[2]):
+            numbers.setdefault(field, len(numbers))
+    # "\0" separates the strings, so a string can't have one in it
+    if any("\0" in string for string in numbers):
+        return False
+    strings = "\0".join(numbers).encode("utf-8")
+    columns = struct.pack("<" + str(len(header)) + "I",
+                          *[numbers[column] for column in header])
+    temp_file_name = temp_name(snapshot_name(file_name))
+    try:
+        with open(temp_file_name, 'wb') as writer_file:
+            writer_file.write(SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC, signature[0], signature[1], len(header),
+                len(strings), len(database)))
+            writer_file.write(strings)
+            writer_file.write(columns)
+            writer_file.write(b"".join(
+                SNAPSHOT_RECORD.pack(numbers[record[0]], numbers[record[1]],
+                                     numbers[record[2]], int(record[3]),
+                                     int(record[4]))
+                for record in database))
+            count("bytes_written", writer_file.tell())
+    except BaseException:
+        os.remove(temp_file_name)
+        raise
+    # Like the csv file, the snapshot is only replaced once it is complete
+    os.replace(temp_file_name, snapshot_name(file_name))
+    return True
+
+
+@timed
+def read_snapshot(file_name, signature=None):
+    ''' (str, tuple) -> (list, list)
+
+    Return the header and database of the csv file_name from its binary
+    snapshot (see write_snapshot), reading the snapshot in one go. If there
+    is no snapshot, or it was made from a different version of the csv file
+    than the one with the given signature (the current one if no signature
+    is given), return None.
+    '''
+    if signature is None:
+        signature = file_signature(file_name)
+    try:
+        with open(snapshot_name(file_name), 'rb') as reader_file:
+            data = reader_file.read()
+    except OSError:
+        return None
+    count("bytes_read", len(data))
+    if len(data) < SNAPSHOT_HEADER.size:
+        return None
+    (magic, modified, size, column_count, strings_size,
+     record_count) = SNAPSHOT_HEADER.unpack_from(data)
+    # The csv file changed since the snapshot was made
+    if magic != SNAPSHOT_MAGIC or signature != (modified, size):
+        return None
+    start = SNAPSHOT_HEADER.size
+    strings = data[start:start + strings_size].decode("utf-8").split("\0")
+    start += strings_size
+    columns = struct.unpack_from("<" + str(column_count) + "I", data, start)
+    start += 4 * column_count
+    header = [strings[number] for number in columns]
+    end = start + SNAPSHOT_RECORD.size * record_count
+    # Every record with the same colour gets the very same string object from
+    # the table, so StoreItem doesn't have to intern them again
+    database = []
+    for category, name, colour, price, quantity in SNAPSHOT_RECORD.iter_unpack(
+            data[start:end]):
+        record = StoreItem.__new__(StoreItem)
+        record.category = strings[category]
+        record.name = strings[name]
+        record.colour = strings[colour]
+        record.price = price
+        record.quantity = quantity
+        database.append(record)
+    count("rows_scanned", record_count)
+    return (header, database)
+
+
+def get_cache_stats():
+    ''' () -> dict
+
+    Return how many read_csv calls were cache hits and misses, and how many
+    files are in the cache.
+    '''
+    return {"hits": CACHE_STATS["hits"], "misses": CACHE_STATS["misses"],
+            "files": len(_csv_cache)}
+
+
+def iter_csv(file_name=None):
+    ''' (str) -> generator
+
+    Given a csv file_name (FILE_NAME if no file_name is given), give back its
+    rows one at a time, starting with the header, without ever keeping the
+    whole file in memory.
+    '''
+    if file_name is None:
+        file_name = FILE_NAME
+    with open(file_name, newline="") as reader_file:
+        count("bytes_read", os.fstat(reader_file.fileno()).st_size)
+        for row in csv.reader(reader_file):
+            yield row
+
+
+def read_current(file_name=None):
+    ''' (str) -> (list, list)
+
+    Like read_csv, but the changes still waiting in the log of file_name
+    (see compact) are applied to the records, so they are what the store
+    holds right now and not only what the csv file says.
+    '''
+    if file_name is None:
+        file_name = FILE_NAME
+    # Without a log, the csv file has everything
+    if not os.path.exists(journal_name(file_name)):
+        return read_csv(file_name)
+    inventory = Inventory(file_name, True, LOCKING_MODE)
+    return (inventory.header, inventory.rows())
 
 
+@timed
 def write_to_csv(data):
     ''' (list) -> NoneType
 
     Write the data to the csv file.
 
-    REQ: data must be a list of lists with consistent number of columns (in each row)
+    REQ: data must be a list of StoreItems or lists with consistent number of columns (in each row)
     '''
+    global _inventory
     # To make our database more organized, we will sort our csv file
     data.sort(key=lambda k: k[0])
     header = read_csv()[0]
-    # Open the file given so we can write on it
-    with open(FILE_NAME, 'w', newline="") as writer_file:
-        writer = csv.writer(writer_file)
-        # When we write the updated database back on the file, we need to
-        # remember to add the header back in as well.
-        writer.writerows([header] + data)
+    # When we write the updated database back on the file, we need to
+    # remember to add the header back in as well.
+    _write_rows(FILE_NAME, header, data)
+    # The data we just wrote is the whole database, so any change still
+    # waiting in the log is out of date
+    if os.path.exists(journal_name(FILE_NAME)):
+        os.remove(journal_name(FILE_NAME))
+    # The file changed behind the inventory's back, so the next call has to
+    # load it again
+    _inventory = None
+
+
+@timed
+def _write_rows(file_name, header, data):
+    ''' (str, list, list) -> NoneType
+
+    Write the header followed by every row of data to file_name.
+
+    The rows are written to a temporary file that then replaces file_name,
+    so anybody reading file_name sees either the old or the new file, never
+    half of it.
+    '''
+    temp_file_name = temp_name(file_name)
+    try:
+        # Open the file given so we can write on it
+        with open(temp_file_name, 'w', newline="") as writer_file:
+            writer = csv.writer(writer_file)
+            writer.writerow(header)
+            writer.writerows(data)
+            count("bytes_written", writer_file.tell())
+            # Make sure everything is on the disk before replacing the file
+            writer_file.flush()
+            os.fsync(writer_file.fileno())
+    except BaseException:
+        os.remove(temp_file_name)
+        raise
+    os.replace(temp_file_name, file_name)
+    # Whatever we had cached for this file is out of date now
+    _csv_cache.pop(os.path.abspath(file_name), None)
+
+
+def temp_name(file_name):
+    ''' (str) -> str
+
+    Return the name of the temporary file this program uses to write a new
+    version of file_name.
+    '''
+    # Every program gets its own temporary file
+    return file_name + "." + str(os.getpid()) + ".tmp"
+
+
+@contextlib.contextmanager
+def file_lock(file_name, shared=False):
+    ''' (str, bool) -> context manager
+
+    Hold a lock on file_name while the with block runs. Only one program at a
+    time can hold the (exclusive) lock; many programs can hold a shared lock
+    together, as long as nobody holds the exclusive one.
+
+    The lock is taken on a separate file next to file_name, because file_name
+    itself gets replaced when it is written. Where file locks don't exist,
+    this does nothing.
+    '''
+    if fcntl is None:
+        yield
+        return
+    with open(file_name + ".lock", 'a') as lock_file:
+        if shared:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+        else:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def journal_name(file_name):
+    ''' (str) -> str
+
+    Return the name of the log that keeps the changes made to file_name.
+    '''
+    return file_name + ".log"
+
+
+def feed_name(file_name):
+    ''' (str) -> str
+
+    Return the name of the feed that keeps the events of file_name.
+    '''
+    return file_name + ".feed"
+
+
+# The last sequence number given to an event of every file, when there is no
+# feed on disk to find it in
+_sequences = {}
+
+
+def subscribe(callback):
+    ''' (function) -> function
+
+    Call callback with every event (see publish) from now on, right after its
+    change is written. Return callback, so subscribe can be used as a
+    decorator:
+
+    >>> @subscribe
+    ... def show(event):
+    ...     print(event["op"], event["key"], event["old"], event["new"])
+    '''
+    SUBSCRIBERS.append(callback)
+    return callback
+
+
+def unsubscribe(callback):
+    ''' (function) -> NoneType
+
+    Stop calling callback with the events.
+    '''
+    SUBSCRIBERS.remove(callback)
+
+
+def feed_enabled():
+    ''' () -> bool
+
+    Return True if somebody wants the events: FEED_MODE is on or there is a
+    subscriber. Otherwise the inventories don't make them at all.
+    '''
+    return FEED_MODE or bool(SUBSCRIBERS)
+
+
+def make_event(change, old, new):
+    ''' (list, StoreItem, StoreItem) -> dict
+
+    Return the event of a change (see Inventory.apply) that turned the record
+    old into the record new. old is None for a new record and new is None
+    for a removed record. The event keeps the fields of both as lists, so
+    later changes to the records don't change it.
+    '''
+    return {"op": change[0], "key": list(change_key(change)),
+            "old": None if old is None else list(old),
+            "new": None if new is None else list(new)}
+
+
+def last_sequence(file_name):
+    ''' (str) -> int
+
+    Return the sequence number of the last event in the feed of file_name,
+    or 0 if there is none.
+    '''
+    try:
+        with open(feed_name(file_name), 'rb') as feed_file:
+            # Only the end of the feed has the last event in it
+            size = feed_file.seek(0, os.SEEK_END)
+            feed_file.seek(max(0, size - 4096))
+            lines = feed_file.read().splitlines()
+    except OSError:
+        return 0
+    if not lines:
+        return 0
+    return json.loads(lines[-1])["seq"]
+
+
+def publish(file_name, events):
+    ''' (str, list) -> NoneType
+
+    Give the next sequence numbers and the time to the events of changes
+    that were just written to file_name, append them to its feed (in
+    FEED_MODE) and call every subscriber with them.
+
+    Every event is a dict with:
+     - "seq": its number, one more than the event before it
+     - "time": when it was published (seconds since the epoch)
+     - "op": "add", "remove", "price" or "purchase"
+     - "key": [name, colour] of the record
+     - "old" and "new": the record before and after the change (as lists),
+       or None
+
+    The feed has one event per line, as JSON. In locking mode the events are
+    published while the file is still locked, so the sequence numbers of
+    every program that changes the file follow each other.
+    '''
+    if not events:
+        return
+    path = os.path.abspath(file_name)
+    if FEED_MODE:
+        sequence = last_sequence(file_name)
+    else:
+        sequence = _sequences.get(path, 0)
+    now = time.time()
+    for event in events:
+        sequence += 1
+        event["seq"] = sequence
+        event["time"] = now
+    _sequences[path] = sequence
+    if FEED_MODE:
+        # Appending lines costs the same no matter how long the feed is
+        lines = "".join(json.dumps(event) + "\n" for event in events)
+        with open(feed_name(file_name), 'a') as feed_file:
+            feed_file.write(lines)
+        count("bytes_written", len(lines))
+    for callback in list(SUBSCRIBERS):
+        for event in events:
+            callback(event)
+
+
+def read_feed(after=0, file_name=None):
+    ''' (int, str) -> generator
+
+    Give back, one at a time, every event in the feed of file_name
+    (FILE_NAME if no file_name is given) with a sequence number greater
+    than after. A program that remembers the last sequence number it saw
+    only has to read the events that came after it:
+
+    >>> for event in read_feed(last_seen):
+    ...     last_seen = event["seq"]
+    '''
+    if file_name is None:
+        file_name = FILE_NAME
+    try:
+        feed_file = open(feed_name(file_name))
+    except OSError:
+        return
+    with feed_file:
+        for line in feed_file:
+            event = json.loads(line)
+            if event["seq"] > after:
+                yield event
+
+
+class Inventory:
+    ''' The store's database, loaded once from the csv file and kept in memory.
+
+    Every record is a StoreItem, so its price and quantity are already ints.
+    The records are kept in a dictionary
+    keyed by (name, colour), so finding an item is a single lookup instead of
+    a loop over the whole database.
+
+    The inventory also keeps some indexes that are updated on every change,
+    so questions like "which items are black?" only look at the answer:
+     - by_colour: colour -> set of the names of the items of that colour
+     - by_name: name -> set of the colours of that item
+     - by_category: category -> set of (name, colour) of the records in it
+     - by_quantity: sorted list of (quantity, name, colour)
+     - stock: the totals of the records (see count_totals)
+    Like the csv file, every answer is given in the order of the file (see
+    in_order).
+
+    The records are also kept in the order of the file (sorted by category),
+    so saving them never has to sort them again:
+     - order: every record, in the order of the file
+     - sort_keys: (category, number) of every record in order, where number
+       is the record's number in sequence. Records of the same category are
+       in the order they were added, so this list is sorted and we can find
+       any record, or where a new one goes, by bisection.
+    '''
+
+    def __init__(self, file_name=None, journal=False, locking=False,
+                 in_place=False):
+        ''' (Inventory, str, bool, bool, bool) -> NoneType
+
+        Create an inventory for file_name (FILE_NAME if no file_name is given)
+        and load its records. If journal is True, changes are appended to a
+        log instead of rewriting the whole file (see compact). If locking is
+        True, the file can safely be changed by many programs at the same time
+        (see write_changes). If in_place is True, changes that keep their rows
+        the same length are written over the old rows (see write_in_place).
+
+        REQ: file_name has to be a valid .csv file with a header
+        '''
+        if file_name is None:
+            file_name = FILE_NAME
+        self.file_name = file_name
+        self.journal = journal
+        self.locking = locking
+        self.in_place = in_place
+        # True while this inventory holds the lock on the file
+        self.locked = False
+        self.header = []
+        self.records = {}
+        self.by_colour = {}
+        self.by_name = {}
+        self.by_category = {}
+        self.by_quantity = []
+        self.stock = new_totals()
+        self.order = []
+        self.sort_keys = []
+        # (name, colour) -> the record's number in sequence, and the number
+        # the next new record gets
+        self.sequence = {}
+        self.next_number = 0
+        # Where every line of the file starts, followed by where the file
+        # ends (see find_offsets), or None if we don't know
+        self.offsets = None
+        # What every line of the file ends with
+        self.line_end = "\r\n"
+        # How many changes are in the log, waiting to be compacted
+        self.journal_size = 0
+        # While a batch is open, changes wait here instead of being written,
+        # and so do their events (see publish)
+        self.pending = None
+        self.events = []
+        # The file whose feed the events go to (a sharded database puts the
+        # events of all its shards in one feed)
+        self.feed_file = file_name
+        # What the csv file and its log looked like when we last read or
+        # wrote them
+        self.signature = None
+        self.load()
+
+    @timed
+    def load(self):
+        ''' (Inventory) -> NoneType
+
+        (Re)load every record from the csv file.
+        '''
+        # Don't let anybody write the file or the log while we read them
+        with self.lock(shared=True):
+            self.signature = self.current_signature()
+            self.header, database = read_csv(self.file_name)
+            self.records = {}
+            # The records are shared with read_csv's cache, so they are never
+            # changed: a change replaces its record with a new one (see
+            # apply)
+            for record in database:
+                # The name and colour are what identify a record
+                self.records[(record.name, record.colour)] = record
+            self.build_order(self.records.values())
+            self.build_indexes()
+            # Changes that were logged but not compacted yet still count
+            self.journal_size = self.replay()
+
+    @contextlib.contextmanager
+    def lock(self, shared=False):
+        ''' (Inventory, bool) -> context manager
+
+        In locking mode, hold the lock on the file while the with block runs
+        (see file_lock). Otherwise, or if we already hold it, do nothing.
+        '''
+        if not self.locking or self.locked:
+            yield
+            return
+        self.locked = True
+        try:
+            with file_lock(self.file_name, shared):
+                yield
+        finally:
+            self.locked = False
+
+    def current_signature(self):
+        ''' (Inventory) -> tuple
+
+        Return the signatures (see file_signature) of the csv file and its log.
+        '''
+        return (file_signature(self.file_name),
+                file_signature(journal_name(self.file_name)))
+
+    def build_order(self, records):
+        ''' (Inventory, iterable) -> NoneType
+
+        Put the records in the order of the file again: by category, keeping
+        the order they are given in within a category.
+        '''
+        # A file we wrote is already sorted, and sorting sorted data only
+        # takes one pass
+        self.order = sorted(records, key=lambda k: k.category)
+        self.sequence = {}
+        self.sort_keys = []
+        for number, record in enumerate(self.order):
+            self.sequence[record.key()] = number
+            self.sort_keys.append((record.category, number))
+        self.next_number = len(self.order)
+        # The rows moved, so we don't know where they are in the file
+        self.offsets = None
+
+    def position(self, record):
+        ''' (Inventory, StoreItem) -> int
+
+        Return where the record is in order.
+
+        REQ: the record is in order
+        '''
+        return bisect.bisect_left(
+            self.sort_keys, (record.category, self.sequence[record.key()]))
+
+    def insert(self, record):
+        ''' (Inventory, StoreItem) -> NoneType
+
+        Put a new record in order, after the other records of its category.
+        '''
+        sort_key = (record.category, self.next_number)
+        self.next_number += 1
+        position = bisect.bisect_left(self.sort_keys, sort_key)
+        self.sort_keys.insert(position, sort_key)
+        self.order.insert(position, record)
+        self.sequence[record.key()] = sort_key[1]
+        self.offsets = None
+
+    def delete(self, record):
+        ''' (Inventory, StoreItem) -> NoneType
+
+        Take a record out of order.
+        '''
+        position = self.position(record)
+        del self.sort_keys[position]
+        del self.order[position]
+        del self.sequence[record.key()]
+        self.offsets = None
+
+    def build_indexes(self):
+        ''' (Inventory) -> NoneType
+
+        Build every index again from the records.
+        '''
+        self.by_colour = {}
+        self.by_name = {}
+        self.by_category = {}
+        self.stock = new_totals()
+        for record in self.records.values():
+            self.index(record, False)
+        # Sorting once is faster than inserting every record in order
+        self.by_quantity = sorted((record.quantity, record.name, record.colour)
+                                  for record in self.records.values())
+
+    def index(self, record, by_quantity=True):
+        ''' (Inventory, StoreItem, bool) -> NoneType
+
+        Add the record to the indexes.
+        '''
+        self.by_colour.setdefault(record.colour, set()).add(record.name)
+        self.by_name.setdefault(record.name, set()).add(record.colour)
+        self.by_category.setdefault(record.category, set()).add(record.key())
+        count_totals(self.stock, record)
+        if by_quantity:
+            bisect.insort(self.by_quantity,
+                          (record.quantity, record.name, record.colour))
+
+    def unindex(self, record):
+        ''' (Inventory, StoreItem) -> NoneType
+
+        Take the record out of the indexes.
+        '''
+        # Remove the record from each index, and forget the index entry
+        # completely once nothing is left in it
+        for index, key, value in ((self.by_colour, record.colour, record.name),
+                                  (self.by_name, record.name, record.colour),
+                                  (self.by_category, record.category,
+                                   record.key())):
+            entries = index[key]
+            entries.remove(value)
+            if not entries:
+                del index[key]
+        count_totals(self.stock, record, -1)
+        # The quantity index is sorted, so we can find the record by bisection
+        position = bisect.bisect_left(
+            self.by_quantity, (record.quantity, record.name, record.colour))
+        del self.by_quantity[position]
+
+    def apply(self, change, events=None):
+        ''' (Inventory, list, list) -> bool
+
+        Apply a change to the records and the indexes. A change is a list
+        that starts with what to do, followed by its arguments:
+         - ["add", category, name, colour, price, quantity]
+         - ["remove", name, colour]
+         - ["price", name, colour, new_price]
+         - ["purchase", name, colour, items_bought]
+        If events is given, the event of the change (see make_event) is
+        added to it. Return True if the record the change is about was found.
+        '''
+        operation = change[0]
+        if operation == "add":
+            record = StoreItem(change[1], change[2], change[3], change[4],
+                               change[5])
+            # Adding a record that already exists replaces it
+            old_record = self.records.get(record.key())
+            if old_record is None:
+                self.insert(record)
+                self.index(record)
+            elif old_record.category == record.category:
+                # The new record takes the old one's place in the file, and
+                # in the indexes: only its quantity and totals can change
+                self.replace(old_record, record)
+            else:
+                self.delete(old_record)
+                self.insert(record)
+                self.unindex(old_record)
+                self.index(record)
+            self.records[record.key()] = record
+            if events is not None:
+                events.append(make_event(change, old_record, record))
+            return True
+        record = self.records.get((change[1], change[2]))
+        if record is None:
+            return False
+        new_record = None
+        if operation == "remove":
+            del self.records[(change[1], change[2])]
+            self.delete(record)
+            self.unindex(record)
+        elif operation in ("price", "purchase"):
+            # The record may be shared with read_csv's cache, so the change
+            # goes into a new record that takes its place. apply_change
+            # turns the number into an int first, so nothing is changed if
+            # it isn't one.
+            new_record = apply_change(record, change)
+            self.replace(record, new_record)
+        if events is not None:
+            events.append(make_event(change, record, new_record))
+        return True
+
+    def replace(self, old_record, record):
+        ''' (Inventory, StoreItem, StoreItem) -> NoneType
+
+        Put the record in the place of old_record, which has the same name,
+        colour and category. Only the quantity index and the totals can
+        change, the other indexes keep the record in its place.
+        '''
+        self.records[record.key()] = record
+        self.order[self.position(old_record)] = record
+        self.offsets = None
+        position = bisect.bisect_left(
+            self.by_quantity,
+            (old_record.quantity, old_record.name, old_record.colour))
+        del self.by_quantity[position]
+        bisect.insort(self.by_quantity,
+                      (record.quantity, record.name, record.colour))
+        count_totals(self.stock, old_record, -1)
+        count_totals(self.stock, record)
+
+    @timed
+    def replay(self):
+        ''' (Inventory) -> int
+
+        Apply every change in the log on top of the records loaded from the
+        csv file. Return how many changes were applied.
+        '''
+        log_name = journal_name(self.file_name)
+        if not os.path.exists(log_name):
+            return 0
+        changes = 0
+        with open(log_name, newline="") as log_file:
+            for change in csv.reader(log_file):
+                self.apply(change)
+                changes += 1
+        count("rows_scanned", changes)
+        return changes
+
+    @timed
+    def save(self):
+        ''' (Inventory) -> NoneType
+
+        Write every record back to the csv file. The file then has every
+        change in it, so the log is not needed any more.
+        '''
+        _write_rows(self.file_name, self.header, self.order)
+        log_name = journal_name(self.file_name)
+        if os.path.exists(log_name):
+            os.remove(log_name)
+        self.journal_size = 0
+        self.signature = self.current_signature()
+        # We only find where the rows are if we need it (see write_in_place)
+        self.offsets = None
+
+    @timed
+    def find_offsets(self):
+        ''' (Inventory) -> NoneType
+
+        Read the csv file once to find where every line starts, so rows can
+        later be written over (see write_in_place). If the rows can't be
+        found that way, offsets stays None.
+        '''
+        self.offsets = None
+        with open(self.file_name, 'rb') as reader_file:
+            data = reader_file.read()
+        count("bytes_read", len(data))
+        # A quoted field may have a comma or a new line in it, so its row is
+        # not simply one line. We don't write over those files.
+        if b'"' in data:
+            return
+        lines = data.split(b"\n")
+        # The header, every record, and the empty part after the last "\n"
+        if len(lines) != len(self.order) + 2 or lines[-1]:
+            return
+        if lines[0].endswith(b"\r"):
+            self.line_end = "\r\n"
+        else:
+            self.line_end = "\n"
+        # Every line is one byte longer than its part, because of the "\n"
+        self.offsets = list(itertools.accumulate(
+            (len(line) + 1 for line in lines[:-1]), initial=0))
+
+    @timed
+    def write_in_place(self, changes):
+        ''' (Inventory, list) -> bool
+
+        Write the rows of the records the changes are about over their old
+        rows in the csv file, instead of writing the whole file. This only
+        works if no row moves: every change is a new price or a purchase and
+        every new row is exactly as long as the old one. Return True if the
+        changes were written.
+
+        Unlike a whole new file (see _write_rows), somebody reading the file
+        at the same time could see a row half written, so this is never done
+        in locking mode. It is not done either while the file has a log (left
+        by journal mode): the records already have the log's changes, so the
+        whole file has to be saved and the log removed (see save), or the
+        next load would apply them again.
+        '''
+        if (not self.in_place or self.locking or self.is_stale()
+                or os.path.exists(journal_name(self.file_name))
+                or any(change[0] not in ("price", "purchase")
+                       for change in changes)):
+            return False
+        if self.offsets is None:
+            self.find_offsets()
+            if self.offsets is None:
+                return False
+        encoding = locale.getpreferredencoding(False)
+        with open(self.file_name, 'r+b') as writer_file:
+            rows = {}
+            for change in changes:
+                record = self.records.get(change_key(change))
+                if record is None:
+                    continue
+                # Line 0 is the header, so the record's line is one further
+                line = self.position(record) + 1
+                start = self.offsets[line]
+                name = ",".join((record.category, record.name,
+                                 record.colour)) + ","
+                row = (name + str(record.price) + "," + str(record.quantity)
+                       + self.line_end).encode(encoding)
+                if len(row) != self.offsets[line + 1] - start:
+                    return False
+                # Make sure the line really is this record's old row (the
+                # file may not have been sorted, or may have a log)
+                writer_file.seek(start)
+                if not writer_file.read(len(row)).startswith(
+                        name.encode(encoding)):
+                    return False
+                rows[start] = row
+            for offset, row in rows.items():
+                writer_file.seek(offset)
+                writer_file.write(row)
+                count("bytes_written", len(row))
+            # Make sure everything is on the disk, like _write_rows does
+            writer_file.flush()
+            os.fsync(writer_file.fileno())
+        # Whatever we had cached for this file is out of date now
+        _csv_cache.pop(os.path.abspath(self.file_name), None)
+        self.signature = self.current_signature()
+        return True
+
+    def is_stale(self):
+        ''' (Inventory) -> bool
+
+        Return True if somebody else changed the csv file or its log since we
+        last read or wrote them.
+        '''
+        return self.current_signature() != self.signature
+
+    def commit(self, change, events=None):
+        ''' (Inventory, list, list) -> NoneType
+
+        Make a change that was applied to the records permanent. In journal
+        mode, the change is appended to the log, otherwise the whole file
+        is saved. Inside a batch, the change (and its events) wait for the
+        end of the batch.
+        '''
+        if self.pending is not None:
+            self.pending.append(change)
+            self.events.extend(events or ())
+        else:
+            self.write_changes([change], False, events)
+
+    @timed
+    def write_changes(self, changes, check=False, events=None):
+        ''' (Inventory, list, bool, list) -> NoneType
+
+        Write the list of changes, which were already applied to the records,
+        to the log (in journal mode) or save the whole file once. Then
+        publish their events, if they are given (see publish).
+
+        In locking mode, the file is locked while we write. If somebody else
+        changed the file since we read it, our changes were made on old data:
+        the records are loaded again and the changes made again on top of
+        them, so nobody's changes get lost. If check is True, the changes are
+        then checked again (see check).
+        '''
+        with self.lock():
+            if self.locking and self.is_stale():
+                self.load()
+                # The records were different, so are the events
+                if events is not None:
+                    events = []
+                for change in changes:
+                    self.apply(change, events)
+                if check:
+                    try:
+                        self.check(changes)
+                    except ValueError:
+                        # Forget our changes, keep what is in the file
+                        self.load()
+                        raise
+            if not self.journal:
+                # Only write the whole file if we can't write just the rows
+                # that changed
+                if not self.write_in_place(changes):
+                    self.save()
+            else:
+                # Appending lines costs the same no matter how big the file is
+                with open(journal_name(self.file_name), 'a',
+                          newline="") as log_file:
+                    start = log_file.tell()
+                    csv.writer(log_file).writerows(changes)
+                    count("bytes_written", log_file.tell() - start)
+                self.journal_size += len(changes)
+                self.signature = self.current_signature()
+                # Don't let the log grow forever, replaying it also takes time
+                if self.journal_size >= COMPACT_AFTER:
+                    self.compact()
+            # The changes are written, now everybody can hear about them
+            if events:
+                publish(self.feed_file, events)
+
+    def check(self, changes):
+        ''' (Inventory, list) -> NoneType
+
+        Raise a ValueError if any of the changes left a record with a
+        negative quantity or a price that is not greater than 0.
+        '''
+        # Only the records that were changed need to be checked
+        for change in changes:
+            record = self.records.get(change_key(change))
+            if record is not None:
+                check_record(record)
+
+    @contextlib.contextmanager
+    def batch(self):
+        ''' (Inventory) -> context manager
+
+        Group many changes so they are checked together and written to the
+        file only once, when the with block ends:
+
+        >>> with inventory.batch():
+        ...     inventory.purchase("pants", "grey", 3)
+        ...     inventory.set_price("pants", "grey", 75)
+
+        If any change leaves a record with a negative quantity or a price
+        that is not greater than 0, or if the with block raises an error,
+        none of the changes are kept and the error is raised.
+        '''
+        # A batch inside a batch is just part of the outer one
+        if self.pending is not None:
+            yield self
+            return
+        # Keep the records as they are so we can go back if anything fails.
+        # A change never changes a record, it puts a new one in its place
+        # (see apply), so we don't need to copy them.
+        backup = dict(self.records)
+        backup_order = [record.key() for record in self.order]
+        self.pending = []
+        self.events = []
+        try:
+            yield self
+            self.check(self.pending)
+        except BaseException:
+            # Throw away every change made in the batch
+            self.records = backup
+            self.build_order(backup[key] for key in backup_order)
+            self.build_indexes()
+            self.pending = None
+            self.events = []
+            raise
+        changes = self.pending
+        events = self.events
+        self.pending = None
+        self.events = []
+        if changes:
+            self.write_changes(changes, True,
+                               events if feed_enabled() else None)
+
+    def compact(self):
+        ''' (Inventory) -> NoneType
+
+        Fold every change in the log back into the (sorted) csv file and
+        start a new, empty log.
+        '''
+        with self.lock():
+            # Make sure we fold the latest changes, not only ours
+            if self.locking and self.is_stale():
+                self.load()
+            # Saving the whole file is exactly that
+            self.save()
+
+    def rows(self):
+        ''' (Inventory) -> list
+
+        Return every record, sorted by category (the order used in the file).
+        '''
+        # The records are always kept in that order, so there is no sorting
+        return list(self.order)
+
+    def get_record(self, item, colour):
+        ''' (Inventory, str, str) -> StoreItem
+
+        Return the record for the item and its colour, or None if there is
+        no such record.
+        '''
+        return self.records.get((item, colour))
+
+    def get_price(self, item, colour):
+        ''' (Inventory, str, str) -> int
+
+        Return the price of the item and its colour, or None if there is
+        no such record.
+        '''
+        record = self.get_record(item, colour)
+        if record is not None:
+            return record.price
+
+    def get_quantity(self, item, colour):
+        ''' (Inventory, str, str) -> int
+
+        Return how many of the item and its colour are in stock, or None if
+        there is no such record.
+        '''
+        record = self.get_record(item, colour)
+        if record is not None:
+            return record.quantity
+
+    def change(self, change):
+        ''' (Inventory, list) -> bool
+
+        Apply the change (see apply) and, if its record was found, commit it.
+        Return True if the record was found.
+        '''
+        events = None
+        if feed_enabled():
+            events = []
+        if not self.apply(change, events):
+            return False
+        self.commit(change, events)
+        return True
+
+    def add(self, category, name, colour, price, quantity):
+        ''' (Inventory, str, str, str, int, int) -> NoneType
+
+        Add a new record and commit the change.
+        '''
+        self.change(["add", category, name, colour, price, quantity])
+
+    def add_many(self, records):
+        ''' (Inventory, list) -> NoneType
+
+        Add every record (a StoreItem) in the list, replacing the records
+        that already exist, and commit the changes all at once.
+
+        Adding records one at a time keeps the order and the indexes right
+        after every record. Here they are only built again once, at the end.
+        '''
+        changes = []
+        events = None
+        if feed_enabled():
+            events = []
+        # Records that are new, or that moved to another category, go after
+        # the other records of their category
+        moved = set()
+        new_records = {}
+        for record in records:
+            record = record.copy()
+            key = record.key()
+            old_record = self.records.get(key)
+            if old_record is None or old_record.category != record.category:
+                moved.add(key)
+                # A record that moves again goes to the end again
+                new_records.pop(key, None)
+                new_records[key] = record
+            elif key in new_records:
+                new_records[key] = record
+            self.records[key] = record
+            changes.append(["add", record.category, record.name, record.colour,
+                            record.price, record.quantity])
+            if events is not None:
+                events.append(make_event(changes[-1], old_record, record))
+        if not changes:
+            return
+        order = [self.records[record.key()] for record in self.order
+                 if record.key() not in moved]
+        self.build_order(order + list(new_records.values()))
+        self.build_indexes()
+        if self.pending is not None:
+            self.pending.extend(changes)
+            self.events.extend(events or ())
+        else:
+            self.write_changes(changes, False, events)
+
+    def remove(self, item, colour):
+        ''' (Inventory, str, str) -> bool
+
+        Remove the record for the item and its colour and commit the change.
+        Return True if the record was found.
+        '''
+        return self.change(["remove", item, colour])
+
+    def set_price(self, item, colour, new_price):
+        ''' (Inventory, str, str, int) -> bool
+
+        Replace the price of the item and its colour with new_price and
+        commit the change. Return True if the record was found.
+        '''
+        return self.change(["price", item, colour, new_price])
+
+    def purchase(self, item, colour, items_bought):
+        ''' (Inventory, str, str, int) -> bool
+
+        Take items_bought out of the stock of the item and its colour and
+        commit the change. Return True if the record was found.
+        '''
+        return self.change(["purchase", item, colour, items_bought])
+
+    def in_order(self, keys):
+        ''' (Inventory, iterable) -> list
+
+        Return the records of the keys (name, colour), in the order of the
+        file.
+        '''
+        records = [self.records[key] for key in keys]
+        # Only the records we give back are sorted, not the whole file
+        records.sort(key=lambda record: (record.category,
+                                         self.sequence[record.key()]))
+        return records
+
+    def items_of_colour(self, colour):
+        ''' (Inventory, str) -> list
 
+        Return the names of all the items that are that colour.
+        '''
+        return [record.name for record in self.in_order(
+            (name, colour) for name in self.by_colour.get(colour, ()))]
 
+    def colours_of_item(self, item):
+        ''' (Inventory, str) -> list
+
+        Return all the colours of the item.
+        '''
+        return [record.colour for record in self.in_order(
+            (item, colour) for colour in self.by_name.get(item, ()))]
+
+    def items_in_category(self, category):
+        ''' (Inventory, str) -> list
+
+        Return (a copy of) every record in the category.
+        '''
+        return [record.copy() for record in
+                self.in_order(self.by_category.get(category, ()))]
+
+    def low_stock(self, min_stock):
+        ''' (Inventory, int) -> list
+
+        Return "colour name" for every record with less than min_stock items,
+        in the order of the file.
+        '''
+        # Everything before the first record with min_stock items is low
+        end = bisect.bisect_left(self.by_quantity, (min_stock,))
+        keys = [(name, colour)
+                for quantity, name, colour in self.by_quantity[:end]]
+        return [record.colour + " " + record.name
+                for record in self.in_order(keys)]
+
+    def totals(self, min_stock):
+        ''' (Inventory, int) -> dict
+
+        Return the totals of the records (see count_totals) and how many
+        records have less than min_stock items ("low_stock").
+        '''
+        # The totals are kept up to date by every change, so we only copy
+        # them
+        totals = dict(self.stock)
+        for group in ("categories", "colours"):
+            totals[group] = {key: dict(total)
+                             for key, total in self.stock[group].items()}
+        totals["low_stock"] = bisect.bisect_left(self.by_quantity,
+                                                 (min_stock,))
+        return totals
+
+
+def new_totals():
+    ''' () -> dict
+
+    Return the totals (see count_totals) of a database with no records.
+    '''
+    return {"records": 0, "units": 0, "value": 0, "categories": {},
+            "colours": {}}
+
+
+def count_totals(totals, record, sign=1):
+    ''' (dict, StoreItem, int) -> NoneType
+
+    Add the record to totals, or take it away if sign is -1. The totals
+    count the records, the units (how many items there are) and the value
+    (price times quantity) of all the records, and of the records of every
+    category and every colour:
+
+    >>> totals = new_totals()
+    >>> count_totals(totals, StoreItem("clothes", "pants", "grey", 70, 3))
+    >>> totals["value"], totals["categories"]["clothes"]["units"]
+    (210, 3)
+
+    This only changes a few numbers, so it takes the same time no matter
+    how many records there are.
+    '''
+    units = record.quantity * sign
+    value = record.price * units
+    totals["records"] += sign
+    totals["units"] += units
+    totals["value"] += value
+    for group, key in (("categories", record.category),
+                       ("colours", record.colour)):
+        total = totals[group].get(key)
+        if total is None:
+            total = {"records": 0, "units": 0, "value": 0}
+            totals[group][key] = total
+        total["records"] += sign
+        total["units"] += units
+        total["value"] += value
+        # Forget a category or colour once it has no records left
+        if not total["records"]:
+            del totals[group][key]
+
+
+def change_key(change):
+    ''' (list) -> tuple
+
+    Return the (name, colour) of the record a change (see Inventory.apply)
+    is about.
+    '''
+    # An added record starts with its category, every other change starts
+    # with the name and colour
+    if change[0] == "add":
+        return (change[2], change[3])
+    return (change[1], change[2])
+
+
+def apply_change(record, change):
+    ''' (StoreItem, list) -> StoreItem
+
+    Return what the record (None if it does not exist) looks like after the
+    change (see Inventory.apply). The record given is not changed.
+    '''
+    if change[0] == "add":
+        return StoreItem(change[1], change[2], change[3], change[4], change[5])
+    if record is None or change[0] == "remove":
+        return None
+    record = record.copy()
+    if change[0] == "price":
+        record.price = int(change[3])
+    elif change[0] == "purchase":
+        record.quantity -= int(change[3])
+    return record
+
+
+def change_events(changes, records):
+    ''' (list, dict) -> list
+
+    Return the event (see make_event) of every change in the list, made one
+    after the other on records ((name, colour) -> the record before the
+    changes, for the records that exist), in the order of the changes. Like
+    in Inventory.apply, a change about a record that doesn't exist makes no
+    event. records ends up with the records after the changes.
+    '''
+    events = []
+    for change in changes:
+        key = change_key(change)
+        old_record = records.get(key)
+        if old_record is None and change[0] != "add":
+            continue
+        new_record = apply_change(old_record, change)
+        events.append(make_event(change, old_record, new_record))
+        records[key] = new_record
+    return events
+
+
+def check_record(record):
+    ''' (StoreItem) -> NoneType
+
+    Raise a ValueError if the record has a negative quantity or a price that
+    is not greater than 0.
+    '''
+    if record.quantity < 0:
+        raise ValueError("Not enough " + record.colour + " " + record.name
+                         + " in stock")
+    if record.price <= 0:
+        raise ValueError("The price of " + record.colour + " " + record.name
+                         + " must be greater than 0")
+
+
+class StreamingInventory:
+    ''' The store's database, read one row at a time straight from the file.
+
+    Nothing but the header is kept in memory, so this works no matter how big
+    the file is. Lookups stop reading as soon as they find their record, and
+    changes are written by copying the file row by row into a new file which
+    then replaces the old one.
+    '''
+
+    def __init__(self, file_name=None, locking=False):
+        ''' (StreamingInventory, str, bool) -> NoneType
+
+        Create a streaming inventory for file_name (FILE_NAME if no file_name
+        is given). If locking is True, the file is locked while it is being
+        copied, so many programs can change it at the same time.
+
+        REQ: file_name has to be a valid .csv file with a header
+        '''
+        if file_name is None:
+            file_name = FILE_NAME
+        self.file_name = file_name
+        self.locking = locking
+        # While a batch is open, changes wait here instead of being written
+        self.pending = None
+        self.load()
+
+    def load(self):
+        ''' (StreamingInventory) -> NoneType
+
+        Read the header of the file again.
+        '''
+        self.header = next(iter_csv(self.file_name))
+
+    def is_stale(self):
+        ''' (StreamingInventory) -> bool
+
+        Return False, every call reads the file again anyway.
+        '''
+        return False
+
+    def compact(self):
+        ''' (StreamingInventory) -> NoneType
+
+        Do nothing, changes are always written straight into the file.
+        '''
+
+    def iter_records(self):
+        ''' (StreamingInventory) -> generator
+
+        Give back every record of the file, one at a time, as a StoreItem.
+        '''
+        rows = iter_csv(self.file_name)
+        # Skip the header
+        next(rows, None)
+        for row in rows:
+            count("rows_scanned", 1)
+            yield StoreItem(*row)
+
+    def rows(self):
+        ''' (StreamingInventory) -> list
+
+        Return every record, in the order of the file.
+        '''
+        return list(self.iter_records())
+
+    def get_record(self, item, colour):
+        ''' (StreamingInventory, str, str) -> StoreItem
+
+        Return the record for the item and its colour, or None if there is
+        no such record.
+        '''
+        for record in self.iter_records():
+            # As soon as we find it, we can stop reading the file
+            if record.name == item and record.colour == colour:
+                return record
+
+    def get_price(self, item, colour):
+        ''' (StreamingInventory, str, str) -> int
+
+        Return the price of the item and its colour, or None if there is
+        no such record.
+        '''
+        record = self.get_record(item, colour)
+        if record is not None:
+            return record.price
+
+    def get_quantity(self, item, colour):
+        ''' (StreamingInventory, str, str) -> int
+
+        Return how many of the item and its colour are in stock, or None if
+        there is no such record.
+        '''
+        record = self.get_record(item, colour)
+        if record is not None:
+            return record.quantity
+
+    def items_of_colour(self, colour):
+        ''' (StreamingInventory, str) -> list
+
+        Return the names of all the items that are that colour.
+        '''
+        return [record.name for record in self.iter_records()
+                if record.colour == colour]
+
+    def colours_of_item(self, item):
+        ''' (StreamingInventory, str) -> list
+
+        Return all the colours of the item.
+        '''
+        return [record.colour for record in self.iter_records()
+                if record.name == item]
+
+    def items_in_category(self, category):
+        ''' (StreamingInventory, str) -> list
+
+        Return every record in the category.
+        '''
+        return [record for record in self.iter_records()
+                if record.category == category]
+
+    def low_stock(self, min_stock):
+        ''' (StreamingInventory, int) -> list
+
+        Return "colour name" for every record with less than min_stock items,
+        in the order of the file.
+        '''
+        return [record.colour + " " + record.name
+                for record in self.iter_records()
+                if record.quantity < min_stock]
+
+    def totals(self, min_stock):
+        ''' (StreamingInventory, int) -> dict
+
+        Return the totals of the records (see count_totals) and how many
+        records have less than min_stock items ("low_stock").
+        '''
+        # Nothing is kept in memory, so we add everything up as we go
+        totals = new_totals()
+        totals["low_stock"] = 0
+        for record in self.iter_records():
+            count_totals(totals, record)
+            if record.quantity < min_stock:
+                totals["low_stock"] += 1
+        return totals
+
+    def change(self, change):
+        ''' (StreamingInventory, list) -> bool
+
+        Write the change (see Inventory.apply) into the file, or keep it
+        for the end of the batch. Return True if the record the change is
+        about was found.
+        '''
+        if change[0] != "add":
+            # Look for the record, as it will be once the changes that are
+            # waiting in the batch are made
+            key = change_key(change)
+            record = self.get_record(key[0], key[1])
+            for waiting in self.pending or ():
+                if change_key(waiting) == key:
+                    record = apply_change(record, waiting)
+            if record is None:
+                return False
+        if self.pending is not None:
+            self.pending.append(change)
+        else:
+            self.write_changes([change])
+        return True
+
+    def add(self, category, name, colour, price, quantity):
+        ''' (StreamingInventory, str, str, str, int, int) -> NoneType
+
+        Add a new record and write it into the file.
+        '''
+        self.change(["add", category, name, colour, price, quantity])
+
+    def add_many(self, records):
+        ''' (StreamingInventory, list) -> NoneType
+
+        Add every record (a StoreItem) in the list, replacing the records
+        that already exist, with a single copy of the file.
+        '''
+        with self.batch():
+            for record in records:
+                self.add(record.category, record.name, record.colour,
+                         record.price, record.quantity)
+
+    def remove(self, item, colour):
+        ''' (StreamingInventory, str, str) -> bool
+
+        Remove the record for the item and its colour from the file.
+        Return True if the record was found.
+        '''
+        return self.change(["remove", item, colour])
+
+    def set_price(self, item, colour, new_price):
+        ''' (StreamingInventory, str, str, int) -> bool
+
+        Replace the price of the item and its colour with new_price in the
+        file. Return True if the record was found.
+        '''
+        return self.change(["price", item, colour, new_price])
+
+    def purchase(self, item, colour, items_bought):
+        ''' (StreamingInventory, str, str, int) -> bool
+
+        Take items_bought out of the stock of the item and its colour in the
+        file. Return True if the record was found.
+        '''
+        return self.change(["purchase", item, colour, items_bought])
+
+    @timed
+    def write_changes(self, changes, check=False):
+        ''' (StreamingInventory, list, bool) -> NoneType
+
+        Make every change in the list with a single copy of the file. New
+        records are written after the last record of their category, so the
+        file stays sorted. Like in Inventory.apply, a record that is added
+        again in the category it already has keeps its place.
+
+        If check is True and a change leaves a record with a negative
+        quantity or a price that is not greater than 0, the file is not
+        changed and a ValueError is raised.
+        '''
+        # Group the changes by the record they are about. A record that is
+        # added gets its final value now, it replaces any old record.
+        changes_of = {}
+        added = {}
+        # The category every add of a record gave it, or None if its adds
+        # gave it different categories or it was removed: only a record
+        # that kept the category of its row can stay in that row
+        kept = {}
+        for change in changes:
+            key = change_key(change)
+            if change[0] == "remove" or (change[0] == "add" and
+                                         kept.get(key, change[1]) != change[1]):
+                kept[key] = None
+            elif change[0] == "add":
+                kept[key] = change[1]
+            if change[0] == "add" or key in added:
+                added[key] = apply_change(added.get(key), change)
+            else:
+                changes_of.setdefault(key, []).append(change)
+        # The added records wait in category order for their place in the file
+        waiting = sorted((record for record in added.values()
+                          if record is not None), key=lambda k: k.category)
+        if check:
+            for record in waiting:
+                check_record(record)
+        if self.locking:
+            with file_lock(self.file_name):
+                self.copy_with_changes(changes, changes_of, added, kept,
+                                       waiting, check)
+        else:
+            self.copy_with_changes(changes, changes_of, added, kept, waiting,
+                                   check)
+
+    def copy_with_changes(self, changes, changes_of, added, kept, waiting,
+                          check):
+        ''' (StreamingInventory, list, dict, dict, dict, list, bool)
+            -> NoneType
+
+        Copy the file row by row into a new file that then replaces it,
+        making the changes in changes_of ((name, colour) -> changes), and
+        writing the records in added in the place of their row if they kept
+        its category (see kept in write_changes), or else after the last
+        record of their category (they wait in waiting, in category order).
+        Then publish the events of the changes, in the order they were made
+        (see change_events).
+        '''
+        temp_file_name = temp_name(self.file_name)
+        # The added records that were written in the place of their row
+        placed = set()
+        # The records the changes are about, as they were in the file before
+        # the changes, to make the events from
+        originals = None
+        if feed_enabled():
+            originals = {}
+        try:
+            with open(temp_file_name, 'w', newline="") as writer_file:
+                writer = csv.writer(writer_file)
+                writer.writerow(self.header)
+                for record in self.iter_records():
+                    key = record.key()
+                    if originals is not None and (key in added
+                                                  or key in changes_of):
+                        originals[key] = record
+                    # An added record replaces the one in the file
+                    if key in added:
+                        if added[key] is None or \
+                                kept.get(key) != record.category:
+                            continue
+                        record = added[key]
+                        placed.add(key)
+                    elif key in changes_of:
+                        for change in changes_of[key]:
+                            record = apply_change(record, change)
+                        if record is None:
+                            continue
+                        if check:
+                            check_record(record)
+                    # Write the added records that go before this one. The
+                    # file is sorted, so the row of a record that kept its
+                    # category always comes before them.
+                    while waiting and waiting[0].category < record.category:
+                        waiting_record = waiting.pop(0)
+                        if waiting_record.key() not in placed:
+                            writer.writerow(waiting_record)
+                    writer.writerow(record)
+                # Whatever is left goes at the end
+                writer.writerows(record for record in waiting
+                                 if record.key() not in placed)
+                count("bytes_written", writer_file.tell())
+        except BaseException:
+            # Leave the file as it was
+            os.remove(temp_file_name)
+            raise
+        os.replace(temp_file_name, self.file_name)
+        if originals is not None:
+            publish(self.file_name, change_events(changes, originals))
+
+    @contextlib.contextmanager
+    def batch(self):
+        ''' (StreamingInventory) -> context manager
+
+        Group many changes so they are all written with a single copy of the
+        file when the with block ends (see Inventory.batch). Queries inside
+        the with block still see the file as it was before the batch.
+        '''
+        # A batch inside a batch is just part of the outer one
+        if self.pending is not None:
+            yield self
+            return
+        self.pending = []
+        try:
+            yield self
+        except BaseException:
+            self.pending = None
+            raise
+        changes = self.pending
+        self.pending = None
+        if changes:
+            self.write_changes(changes, True)
+
+
+# The inventory is only loaded the first time somebody needs it
+_inventory = None
+# The FILE_NAME the inventory was made for
+_inventory_file = None
+
+
+def get_inventory():
+    ''' () -> Inventory
+
+    Return the store's inventory, loading it from FILE_NAME the first time
+    and again whenever the file was changed by somebody else. In streaming
+    mode, return a StreamingInventory instead.
+    '''
+    global _inventory, _inventory_file
+    if _inventory is None or _inventory_file != FILE_NAME:
+        if STREAMING_MODE:
+            _inventory = StreamingInventory(FILE_NAME, LOCKING_MODE)
+        else:
+            _inventory = Inventory(FILE_NAME, JOURNAL_MODE, LOCKING_MODE,
+                                   IN_PLACE_MODE)
+        _inventory_file = FILE_NAME
+    elif _inventory.pending is None and _inventory.is_stale():
+        _inventory.load()
+    return _inventory
+
+
+def use_inventory(inventory):
+    ''' (Inventory) -> NoneType
+
+    Make every function of the store use the given inventory (an Inventory,
+    a StreamingInventory, or anything with the same methods) from now on.
+    '''
+    global _inventory, _inventory_file
+    _inventory = inventory
+    _inventory_file = FILE_NAME
+
+
+def compact():
+    ''' () -> NoneType
+
+    Fold every change waiting in the log back into the csv file.
+    '''
+    get_inventory().compact()
+
+
+def batch():
+    ''' () -> context manager
+
+    Group many add_item, remove_item, update_price and purchase_items calls
+    so they are checked together and the file is written only once:
+
+    >>> with batch():
+    ...     purchase_items("pants", "grey", 3)
+    ...     purchase_items("shirt", "white", 1)
+
+    REQ: no call inside the batch should leave an item with a negative
+    quantity or a price that is not greater than 0, otherwise none of the
+    changes are kept.
+    '''
+    return get_inventory().batch()
+
+
+@timed
 def get_item_price(item, colour):
     ''' (str, str) -> int
 
@@ -52,17 +2029,12 @@ def get_item_price(item, colour):
     REQ: item and colour should be valid (the record should exist
     in the database)
     '''
-    # Loop through every item in the database list (every row in the database)
-    database = read_csv()[1]
-    for item_record in database:
-        # Every row in the database is a list itself, and we need to check
-        # we find the right item and its colour
-        if item_record[1] == item and item_record[2] == colour:
-            # If you find the item, get the price and return it.
-            # Make sure it's the right type!
-            return int(item_record[3])
+    # The inventory finds the record straight from its name and colour,
+    # no need to loop through the database
+    return get_inventory().get_price(item, colour)
 
 
+@timed
 def get_item_quantity(item, colour):
     ''' (str, str) -> int
 
@@ -71,35 +2043,83 @@ def get_item_quantity(item, colour):
     REQ: item and colour should be valid (the record should exist
     in the database)
     '''
-    # Loop through every item in the database list (every row in the database)
-    database = read_csv()[1]
-    for item_record in database:
-        # Every row in the database is a list itself, and we need to check
-        # we find the right item and its colour
-        if item_record[1] == item and item_record[2] == colour:
-            # If you find the item, get the quantity and return it.
-            # Make sure it's the right type!
-            return int(item_record[4])
+    # The inventory finds the record straight from its name and colour,
+    # no need to loop through the database
+    return get_inventory().get_quantity(item, colour)
 
 
+@timed
 def add_item(category, name, colour, price, quantity):
     ''' (str, str, str, int, int) -> NoneType
 
-    Given details for a new item, update the csv file.
+    Given details for a new item, update the csv file. If there already is
+    a record for the item and its colour, nothing is changed (use
+    import_items to replace records).
 
-    REQ: all input should be valid (the record should not already exist
-    in the database)
+    REQ: all input should be valid
     '''
-    # Create a new record
-    database = read_csv()[1]
-    item_record = [category, name, colour, price, quantity]
-    # Add the item record at the end of the database
-    database += [item_record]
-    # Write the new database to the file
-    write_to_csv(database)
+    inventory = get_inventory()
+    # The name and colour are what identify a record, so there can't be two
+    if inventory.get_record(name, colour) is not None:
+        print("Item already exists!")
+        return
+    # Add the new record to the inventory, which also updates the file
+    inventory.add(category, name, colour, price, quantity)
     print("Item added successfully!")
 
 
+@timed
+def import_items(file_name):
+    ''' (str) -> dict
+
+    Given a csv file_name with a header and the same columns as the store's
+    file (for example a supplier's feed), add every record in it to the
+    database. A record for an item and colour that is already in the
+    database replaces it. Rows that are not valid records (not 5 columns, a
+    price or quantity that is not a number, a price that is not greater than
+    0 or a negative quantity) are left out.
+
+    The file is read one row at a time and the database is written only
+    once, at the end (see Inventory.add_many). Return how many records were
+    inserted, updated and rejected, and why every rejected row (by its line
+    number) was rejected.
+
+    Example:
+    >>> import_items("new_items.csv")
+    {'inserted': 2, 'updated': 1, 'rejected': 0, 'errors': []}
+    '''
+    inventory = get_inventory()
+    result = {"inserted": 0, "updated": 0, "rejected": 0, "errors": []}
+    rows = iter_csv(file_name)
+    # Skip the header
+    next(rows, None)
+    # Go through the database once to remember which records it has, then
+    # every row of the file only needs a lookup to know if it is new or not
+    known = set(record.key() for record in inventory.rows())
+    records = []
+    # The header is line 1
+    for line, row in enumerate(rows, 2):
+        try:
+            if len(row) != 5:
+                raise ValueError("A record has 5 columns, not "
+                                 + str(len(row)))
+            record = StoreItem(*row)
+            check_record(record)
+        except ValueError as error:
+            result["rejected"] += 1
+            result["errors"].append((line, str(error)))
+            continue
+        if record.key() in known:
+            result["updated"] += 1
+        else:
+            result["inserted"] += 1
+            known.add(record.key())
+        records.append(record)
+    inventory.add_many(records)
+    return result
+
+
+@timed
 def remove_item(item, colour):
     ''' (str, str) -> NoneType
 
@@ -109,22 +2129,12 @@ def remove_item(item, colour):
     REQ: item and colour should be valid (the record should exist
     in the database)
     '''
-    # Loop through every item in the database list a.k.a every row in the
-    # database.
-    database = read_csv()[1]
-    for item_record in database:
-        # Every row in the database is a list itself, and we need to check
-        # we find the right item and its colour
-        if item_record[1] == item and item_record[2] == colour:
-            # If you find the record, remove it from the database
-            database.remove(item_record)
-            # As soon as you find it, you want to quit the loop
-            print("Item removed successfully!")
-            break
-    # Write the new database to the file
-    write_to_csv(database)
+    # Remove the record from the inventory, which also updates the file
+    if get_inventory().remove(item, colour):
+        print("Item removed successfully!")
 
 
+@timed
 def update_price(item, colour, new_price):
     ''' (str, str, int) -> NoneType
 
@@ -142,23 +2152,12 @@ def update_price(item, colour, new_price):
     >>> get_item_price("pants", "grey")
     70
     '''
-    database = read_csv()[1]
-    # Loop through every item in the database list a.k.a every row in the
-    # database.
-    for item_record in database:
-        # Every row in the database is a list itself, and we need to check
-        # we find the right item and its colour
-        if item_record[1] == item and item_record[2] == colour:
-            # If you find the record, replace it's current price
-            # with the new price, remember the price is in index 3
-            item_record[3] = new_price
-            # As soon as you completed the update, you want to quit the loop
-            print("Item price was successfully updated!")
-            break
-    # Write the new database to the file
-    write_to_csv(database)
+    # Replace the price in the inventory, which also updates the file
+    if get_inventory().set_price(item, colour, new_price):
+        print("Item price was successfully updated!")
 
 
+@timed
 def purchase_items(item, colour, items_bought):
     ''' (str, str, int) -> NoneType
 
@@ -180,74 +2179,306 @@ def purchase_items(item, colour, items_bought):
     >>> get_item_quantity("pants", "grey")
     77
     '''
-    database = read_csv()[1]
-    # Loop through every item in the database list a.k.a every row in the
-    # database.
-    for item_record in database:
-        # Every row in the database is a list itself, and we need to check
-        # we find the right item and its colour
-        if item_record[1] == item and item_record[2] == colour:
-            # If you find the record, replace it's current quantity
-            # remember the price is in index 4
-            item_record[4] = int(item_record[4]) - items_bought
-            # As soon as you completed the update, you want to quit the loop
-            print("Item price was successfully updated!")
-            break
-    # Write the new database to the file
-    write_to_csv(database)
+    # Update the quantity in the inventory, which also updates the file
+    if get_inventory().purchase(item, colour, items_bought):
+        print("Item price was successfully updated!")
 
+
+@timed
 def get_items_of_colour(colour):
     ''' (str) -> list
 
     Given a colour, return a list of all the items that are that colour.
     '''
-    # Create a list to store the items that will be returned
-    colour_items = []
-    # Loop through every item in the database list (every row in the database)
-    database = read_csv()[1]
-    for item_record in database:
-        # Every row in the database is a list itself, and we need to check
-        # we find the right colour
-        if item_record[2] == colour:
-            # Add the item to the list
-            colour_items.append(item_record[1])
-    return colour_items
+    return get_inventory().items_of_colour(colour)
+
 
+@timed
 def get_colours_of_item(item):
     ''' (str) -> list
 
     Given an item, return a list of all its colours.
     '''
-    # Create a list to store the items that will be returned
-    item_colour = []
-    # Loop through every item in the database list (every row in the database)
-    database = read_csv()[1]
-    for item_record in database:
-        # Every row in the database is a list itself, and we need to check
-        # we find the right item
-        if item_record[1] == item:
-            # Add the item to the list
-            item_colour.append(item_record[2])
-    return item_colour
+    return get_inventory().colours_of_item(item)
 
+
+@timed
+def get_items_in_category(category):
+    ''' (str) -> list
+
+    Given a category, return a list of all its records.
+    '''
+    return get_inventory().items_in_category(category)
+
+
+@timed
 def low_in_stock():
     ''' () -> list
 
-    Return a list of all the items that have stock less than MIN_STOCK
-    '''
-    # Create a list to store the items that will be returned
-    low_items = []
-    # Loop through every item in the database list (every row in the database)
-    database = read_csv()[1]
-    for item_record in database:
-        # Every row in the database is a list itself, and we need to check
-        # we find the right item
-        if int(item_record[4]) < MIN_STOCK:
-            # Specify what colour it is
-            item = item_record[2] + " " + item_record[1]
-            # Add the item to the list
-            low_items.append(item)
-    return low_items
+    Return a list of all the items that have stock less than MIN_STOCK, in
+    the order of the file.
+    '''
+    return get_inventory().low_stock(MIN_STOCK)
+
+
+@timed
+def get_totals():
+    ''' () -> dict
+
+    Return how many records, units (items in stock) and how much value
+    (price times quantity) the store has, in total and for every category
+    and every colour, and how many records have less than MIN_STOCK items.
+    The totals are kept up to date by every change, so this doesn't go
+    through the database:
+
+    >>> totals = get_totals()
+    >>> totals["value"], totals["categories"]["clothes"]["units"]
+    >>> totals["low_stock"]
+    '''
+    return get_inventory().totals(MIN_STOCK)
+
+
+def mmap_rows(pattern, file_name=None, start=None, end=None):
+    ''' (re.Pattern, str, int, int) -> generator
+
+    Give back, as a list of strings, every record of the csv file_name
+    (FILE_NAME if no file_name is given) in which the bytes pattern is found.
+
+    The file is mapped in memory instead of read, and the pattern is looked
+    for in the raw bytes, so rows where it is not found are never turned into
+    strings at all. Rows with a quote in them are read with the csv module.
+
+    If start and end (positions in bytes, see split_file) are given, only
+    the rows between them are read, otherwise every row after the header.
+    '''
+    if file_name is None:
+        file_name = FILE_NAME
+    encoding = locale.getpreferredencoding(False)
+    with open(file_name, 'rb') as reader_file:
+        # An empty file can't be mapped, and has no records anyway
+        if os.fstat(reader_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(reader_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as data:
+            if start is None:
+                # The records start after the header
+                start = data.find(b"\n") + 1
+                if start == 0:
+                    return
+            if end is None:
+                end = len(data)
+            count("bytes_read", end - start)
+            # Where the last row we gave back ends
+            last_end = start
+            for match in pattern.finditer(data, start, end):
+                # The pattern can be found twice in the same row
+                if match.start() < last_end:
+                    continue
+                # Find the row the pattern is in
+                row_start = data.rfind(b"\n", start, match.start()) + 1
+                if row_start == 0:
+                    row_start = start
+                row_end = data.find(b"\n", match.end(), end)
+                if row_end == -1:
+                    row_end = end
+                last_end = row_end
+                count("rows_scanned", 1)
+                line = data[row_start:row_end].decode(encoding).rstrip("\r")
+                if '"' in line:
+                    yield next(csv.reader([line]))
+                else:
+                    yield line.split(",")
+
+
+def field_pattern(value):
+    ''' (str) -> re.Pattern
+
+    Return a pattern that finds value as a whole field that is not the first
+    of its row (written the way the csv module would write it).
+    '''
+    # Let the csv module add quotes if the value needs them
+    text = io.StringIO()
+    csv.writer(text, lineterminator="").writerow(["", value])
+    field = text.getvalue().encode(locale.getpreferredencoding(False))
+    # The field starts after a comma and ends right before the next one
+    # (or the end of the line), which we check without going past it
+    return re.compile(re.escape(field) + rb"(?=,|\r?$)", re.MULTILINE)
+
+
+def less_than_pattern(number):
+    ''' (int) -> re.Pattern
+
+    Return a pattern that finds a last field (the quantity) holding a whole
+    number less than number, so rows with enough stock are never decoded.
+
+    REQ: number has to be greater than 0
+    '''
+    digits = str(number)
+    # Every negative number is less than a positive one, and a number with
+    # fewer digits is less too
+    options = [rb"-\d+"]
+    if len(digits) > 1:
+        options.append(rb"\d{1," + str(len(digits) - 1).encode() + rb"}")
+    # A number with as many digits is less if it starts the same way and
+    # then has a smaller digit
+    for position in range(len(digits)):
+        if digits[position] > "0":
+            options.append(digits[:position].encode() + b"[0-"
+                           + str(int(digits[position]) - 1).encode() + b"]"
+                           + rb"\d" * (len(digits) - position - 1))
+    return re.compile(b",(?:" + b"|".join(options) + rb")\r?$", re.MULTILINE)
+
+
+@timed
+def mmap_low_in_stock(min_stock=None, file_name=None, start=None, end=None):
+    ''' (int, str, int, int) -> list
+
+    Return "colour name" for every record with less than min_stock (MIN_STOCK
+    if min_stock is not given) items, in the order of the file (see
+    mmap_rows). Only the rows we return are turned into strings.
+    '''
+    if min_stock is None:
+        min_stock = MIN_STOCK
+    results = []
+    # For 0 or less, we can't tell from the digits, so we look at every row
+    if min_stock <= 0:
+        pattern = re.compile(rb",-?\d+\r?$", re.MULTILINE)
+    else:
+        pattern = less_than_pattern(min_stock)
+    for row in mmap_rows(pattern, file_name, start, end):
+        if int(row[4]) < min_stock:
+            results.append(row[2] + " " + row[1])
+    return results
+
+
+@timed
+def mmap_items_of_colour(colour, file_name=None, start=None, end=None):
+    ''' (str, str, int, int) -> list
+
+    Given a colour, return a list of all the items that are that colour, in
+    the order of the file (see mmap_rows).
+    '''
+    return [row[1] for row in mmap_rows(field_pattern(colour), file_name,
+                                        start, end)
+            if row[2] == colour]
+
+
+@timed
+def mmap_colours_of_item(item, file_name=None, start=None, end=None):
+    ''' (str, str, int, int) -> list
+
+    Given an item, return a list of all its colours, in the order of the
+    file (see mmap_rows).
+    '''
+    return [row[2] for row in mmap_rows(field_pattern(item), file_name,
+                                        start, end)
+            if row[1] == item]
+
+
+def split_file(file_name, chunks):
+    ''' (str, int) -> list
+
+    Split the records of the csv file_name into about the given number of
+    chunks, and return the (start, end) position in bytes of every chunk.
+    Every chunk starts at the beginning of a row and ends at the end of one,
+    and the header is not in any of them.
+
+    REQ: no field in the file has a new line in it
+    '''
+    size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as reader_file:
+        # The records start after the header
+        reader_file.readline()
+        start = reader_file.tell()
+        edges = [start]
+        for chunk in range(1, chunks):
+            position = start + (size - start) * chunk // chunks
+            if position <= edges[-1]:
+                continue
+            # We probably landed in the middle of a row, so move on to the
+            # start of the next one
+            reader_file.seek(position - 1)
+            reader_file.readline()
+            if edges[-1] < reader_file.tell() < size:
+                edges.append(reader_file.tell())
+    edges.append(size)
+    return [(edges[i], edges[i + 1]) for i in range(len(edges) - 1)]
+
+
+def scan_chunk(task):
+    ''' (tuple) -> list
+
+    Given a task (file_name, start, end, query, value), answer the query for
+    the rows between the start and end positions (in bytes) of file_name:
+     - "low_stock": "colour name" of every record with less than value items
+     - "colour": names of the items that are colour value
+     - "item": colours of the item value
+    '''
+    file_name, start, end, query, value = task
+    if query == "low_stock":
+        return mmap_low_in_stock(value, file_name, start, end)
+    if query == "colour":
+        return mmap_items_of_colour(value, file_name, start, end)
+    if query == "item":
+        return mmap_colours_of_item(value, file_name, start, end)
+
+
+@timed
+def parallel_scan(query, value, file_name=None, processes=None):
+    ''' (str, object, str, int) -> list
+
+    Answer the query (see scan_chunk) by reading the csv file_name (FILE_NAME
+    if no file_name is given) in chunks, using processes programs at the same
+    time (one per CPU if processes is not given). The results are in the
+    order of the file.
+
+    REQ: no field in the file has a new line in it
+    '''
+    if file_name is None:
+        file_name = FILE_NAME
+    if processes is None:
+        processes = os.cpu_count() or 1
+    tasks = [(file_name, start, end, query, value)
+             for start, end in split_file(file_name, processes)]
+    # With a single chunk, starting other programs only costs time
+    if len(tasks) == 1:
+        chunk_results = [scan_chunk(tasks[0])]
+    else:
+        with multiprocessing.Pool(min(processes, len(tasks))) as pool:
+            # map gives back the results in the same order as the tasks
+            chunk_results = pool.map(scan_chunk, tasks)
+    results = []
+    for chunk_result in chunk_results:
+        results += chunk_result
+    return results
+
+
+def parallel_low_in_stock(processes=None):
+    ''' (int) -> list
+
+    Return a list of all the items that have stock less than MIN_STOCK, in
+    the order of the file, reading the file with many programs at once.
+    '''
+    return parallel_scan("low_stock", MIN_STOCK, None, processes)
+
+
+def parallel_items_of_colour(colour, processes=None):
+    ''' (str, int) -> list
+
+    Given a colour, return a list of all the items that are that colour,
+    reading the file with many programs at once.
+    '''
+    return parallel_scan("colour", colour, None, processes)
+
+
+def parallel_colours_of_item(item, processes=None):
+    ''' (str, int) -> list
+
+    Given an item, return a list of all its colours, reading the file with
+    many programs at once.
+    '''
+    return parallel_scan("item", item, None, processes)
+
 
 def shopping_list():
     ''' () -> list
@@ -273,6 +2504,102 @@ def shopping_list():
     return shopping_list
 
 
+@timed
+def quote(cart, inventory=None):
+    ''' (list, object) -> (int, str)
+
+    Given a cart (a list, or any iterable, of [item, colour, quantity]), look
+    up every line once in the inventory (the store's inventory if none is
+    given) and return how much the whole cart costs, and a message
+    explaining why it can't be bought (None if it can). A line that is not
+    exactly an item, a colour and a quantity greater than 0 is a problem
+    too, and doesn't count in the cost.
+
+    Example:
+    >>> quote([["shirt", "white", 1], ["notebook", "black", 2]])
+    (60, None)
+    >>> quote([["shirt", "white", 1000]])
+    (50000, 'Sorry, there are only 110 white shirt in stock')
+    '''
+    if inventory is None:
+        inventory = get_inventory()
+    cost = 0
+    problem = None
+    # The same item can be in the cart more than once, so we add up how many
+    # we need of each before checking the stock
+    wanted = {}
+    for line in cart:
+        try:
+            item, colour, quantity = line
+            # A quantity like 2.5 is not a number of items either
+            if isinstance(quantity, float):
+                raise ValueError
+            quantity = int(quantity)
+        except (TypeError, ValueError):
+            quantity = 0
+        # Buying less than one item would put items back in stock
+        if quantity <= 0:
+            if problem is None:
+                problem = ("Sorry, " + repr(line) + " is not an item, a "
+                           "colour and a quantity greater than 0")
+            continue
+        key = (item, colour)
+        wanted[key] = wanted.get(key, 0) + quantity
+    for (item, colour), quantity in wanted.items():
+        record = inventory.get_record(item, colour)
+        if record is None:
+            # Don't stop at the first problem, we still want the cost of
+            # everything else
+            if problem is None:
+                problem = "Sorry, we don't sell " + colour + " " + item
+            continue
+        cost += record.price * quantity
+        if record.quantity < quantity and problem is None:
+            problem = ("Sorry, there are only " + str(record.quantity) + " "
+                       + colour + " " + item + " in stock")
+    return (cost, problem)
+
+
+@timed
+def checkout(cart, budget):
+    ''' (list, int) -> (bool, str)
+
+    Given a cart (a list, or any iterable, of [item, colour, quantity]) and a
+    budget, buy everything in the cart if it is all in stock and the user can
+    afford it. All the items are bought together, with a single write, or
+    none of them are.
+    Return whether the cart was bought and a message for the user.
+
+    REQ: The budget has to be equal or greater than 0.
+
+    Example:
+    >>> checkout([["shirt", "white", 1], ["notebook", "black", 2]], 100)
+    (True, 'Thanks for your purchase! Your change is $40')
+    >>> checkout([["shirt", "white", 1]], 10)
+    (False, 'No, you are $40 short')
+    '''
+    # We need to go through the cart more than once
+    cart = list(cart)
+    cost, problem = quote(cart)
+    if problem is not None:
+        return (False, problem)
+    # If we are not under budget, inform the user how much they are short.
+    if cost > budget:
+        return (False, "No, you are $" + str(cost - budget) + " short")
+    inventory = get_inventory()
+    try:
+        # Buy everything at once, so the file is only written one time
+        with inventory.batch():
+            for line in cart:
+                inventory.purchase(line[0], line[1], int(line[2]))
+    except ValueError as error:
+        # Somebody else bought the last ones while we were checking
+        return (False, "Sorry, " + str(error))
+    return (True, "Thanks for your purchase! Your change is $"
+            + str(budget - cost))
+
+
+@timed
 def can_i_buy(budget):
     ''' (int) -> str
 
@@ -289,60 +2616,235 @@ def can_i_buy(budget):
     items to your shopping list: notebook black 2
     Enter an item followed by it's colour and quantity, enter STOP once you are done adding 
     items to your shopping list: STOP
-    Yes, your total cost will be $50. Would you like to buy them? (Yes/No) Yes
+    Yes, your total cost will be $60. Would you like to buy them? (Yes/No) Yes
     'Thanks for your purchase! Your change is $40'
     '''
     # Get the shopping list
     cart = shopping_list()
-    # Create a variable to keep track of the cost
-    cost = 0
-    # We need to get each item from our shopping cart
-    for item in cart:
-        # Get its price
-        price = get_item_price(item[0], item[1])
-        # Add the price times the quantity to the cost
-        cost += int(price) * int(item[2])
+    # Get the cost of the whole cart at once
+    cost, problem = quote(cart)
+    # If something in the cart is not for sale, there's nothing to buy
+    if problem is not None:
+        buy_message = problem
     # If we are under budget
-    if budget >= cost:
+    elif budget >= cost:
         buy_message = "See you next time!"
         # Ask the user if they would like to proceed with the purchase
         confirmation = input("Yes, your total cost will be $" + str(cost) + ". Would you like to buy them? (Yes/No) ")
         # If they do, we need to update our database!
         if confirmation == "Yes":
-            for item in cart:
-                purchase_items(item[0], item[1], int(item[2]))
             # Informe the user that the purchase was completed and their change
-            buy_message = "Thanks for your purchase! Your change is $" + str(budget - cost)
+            buy_message = checkout(cart, budget)[1]
     # If we are not under budget, inform the user how much they are short.
     else:
         buy_message = "No, you are $" + str(cost - budget) + " short"
     return buy_message
 
-def get_csv():
-    ''' () -> NoneType
+@timed
+def get_csv(out=None, limit=None, offset=0, columns=None, auto_size=False):
+    ''' (file, int, int, list, bool) -> NoneType
 
     Print the csv file in a table format.
+
+    The table is written to out (anything with a write method, like a file
+    or a socket's makefile) instead of the screen if out is given. Only the
+    records from number offset on are written, at most limit of them (all
+    of them if no limit is given), and only the columns named in columns
+    (all of them if no columns are given). If auto_size is True, every
+    column is as wide as its widest value instead of COLUMN_WIDTH.
+
+    >>> get_csv(limit=1, columns=["Name", "Price"])
+    Name        	Price       	
+    ------------	------------	
+    shirt       	50          	
+
+    REQ: every name in columns is in the header
+    '''
+    # Get the current data from the inventory
+    inventory = get_inventory()
+    # A streaming inventory gives back one record at a time, so we never
+    # hold more than one page of the table
+    if isinstance(inventory, StreamingInventory):
+        records = inventory.iter_records()
+    else:
+        records = inventory.rows()
+    if limit is None:
+        page = itertools.islice(records, offset, None)
+    else:
+        page = itertools.islice(records, offset, offset + limit)
+    write_table(inventory.header, page, out, columns, auto_size)
+
+
+def write_table(header, records, out=None, columns=None, auto_size=False):
+    ''' (list, iterable, file, list, bool) -> NoneType
+
+    Write the header and the records as a table (see get_csv) to out (the
+    screen if no out is given), ROWS_PER_WRITE rows at a time.
+
+    REQ: every name in columns is in the header
     '''
-    # Get the current data from the file
-    csv_header, csv_data = read_csv()
+    if out is None:
+        out = sys.stdout
+    # Find which fields of a record go in the table
+    if columns is None:
+        positions = list(range(len(header)))
+    else:
+        positions = [header.index(column) for column in columns]
+    header = [header[position] for position in positions]
+    if auto_size:
+        # We need to see every record before writing the first one, so we
+        # turn them into text once and keep them
+        records = [[str(record[position]) for position in positions]
+                   for record in records]
+        widths = [len(column) for column in header]
+        for row in records:
+            for number, field in enumerate(row):
+                if len(field) > widths[number]:
+                    widths[number] = len(field)
+        # The records only have the fields of the table now
+        positions = list(range(len(header)))
+    else:
+        widths = [COLUMN_WIDTH] * len(header)
     # Create some header separators
-    separators = ["------------", "------------", "------------", "------------", "------------"]
-    # Join all the lists to print 
-    data_to_print = [csv_header] + [separators] + csv_data
-    table = ""
-    # Get every row of data
-    for row in data_to_print:
-        item_to_print = ""
-        # For every row of data, you want to get every element
-        for item in row:
-            # We want to format every element so it has 12 characters
-            # and add a tab at the end
-            item_to_print += '{:12}'.format(item) + "\t"
-        # For every row of data, we want to indicate it needs to be printed
-        # in a new line
-        table += item_to_print + "\n"
-    # Print the table
-    print(table)
+    separators = ["-" * width for width in widths]
+    # We want to format every element so it has the width of its column and
+    # add a tab at the end. Every row is then printed in a new line.
+    row_format = "".join("{:" + str(width) + "}\t" for width in widths) + "\n"
+    lines = [row_format.format(*header), row_format.format(*separators)]
+    for record in records:
+        lines.append(row_format.format(
+            *[str(record[position]) for position in positions]))
+        # Building one string out of many lines and writing it at once is a
+        # lot faster than writing (or adding) the lines one at a time
+        if len(lines) >= ROWS_PER_WRITE:
+            out.write("".join(lines))
+            lines = []
+    # print() used to add an empty line after the table
+    lines.append("\n")
+    out.write("".join(lines))
+
+
+def main(arguments=None):
+    ''' (list) -> NoneType
+
+    Use the store from the command line. With no command, print the header
+    and the database to see how they are set up:
+
+    $ python3 store.py
+    $ python3 store.py price pants grey
+    $ python3 store.py --file other_items.csv low-stock
+    '''
+    global FILE_NAME, JOURNAL_MODE, STREAMING_MODE, LOCKING_MODE, SNAPSHOT_MODE
+    global FEED_MODE
+    parser = argparse.ArgumentParser(description="Look at and use the store.")
+    parser.add_argument("--file", default=FILE_NAME,
+                        help="the store's csv file")
+    parser.add_argument("--journal", action="store_true",
+                        help="use the store's journal mode")
+    parser.add_argument("--streaming", action="store_true",
+                        help="use the store's streaming mode")
+    parser.add_argument("--locking", action="store_true",
+                        help="use the store's locking mode")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="use the store's snapshot mode")
+    parser.add_argument("--feed", action="store_true",
+                        help="append every change to the store's feed")
+    parser.add_argument("--profile", action="store_true",
+                        help="run the command under cProfile (see profile)")
+    parser.add_argument("--stats",
+                        help="save what STORE_STATS=1 counted in this file")
+    commands = parser.add_subparsers(dest="command")
+    # With no command, show the data
+    parser.set_defaults(command="show")
+    commands.add_parser("show", help="print the header and the database")
+    table_parser = commands.add_parser("table",
+                                       help="print the database as a table")
+    table_parser.add_argument("--limit", type=int,
+                              help="print at most this many records")
+    table_parser.add_argument("--offset", type=int, default=0,
+                              help="skip this many records first")
+    table_parser.add_argument("--columns",
+                              help="comma separated columns to print")
+    table_parser.add_argument("--auto-size", action="store_true",
+                              help="make every column as wide as it needs")
+    for command, text in (("price", "print the price of an item"),
+                          ("quantity", "print how many of an item are left")):
+        command_parser = commands.add_parser(command, help=text)
+        command_parser.add_argument("item")
+        command_parser.add_argument("colour")
+    commands.add_parser("colour", help="print the items of a colour"
+                        ).add_argument("colour")
+    commands.add_parser("colours", help="print the colours of an item"
+                        ).add_argument("item")
+    commands.add_parser("low-stock", help="print the items low in stock")
+    commands.add_parser("totals", help="print the stock's units and value")
+    commands.add_parser("buy", help="enter a shopping list and buy it"
+                        ).add_argument("budget", type=int)
+    commands.add_parser("import", help="add or replace the records of a csv"
+                        ).add_argument("feed")
+    commands.add_parser("feed", help="print the events in the store's feed"
+                        ).add_argument("--after", type=int, default=0,
+                                       help="only events after this number")
+    options = parser.parse_args(arguments)
+    FILE_NAME = options.file
+    JOURNAL_MODE = options.journal
+    STREAMING_MODE = options.streaming
+    LOCKING_MODE = options.locking
+    SNAPSHOT_MODE = options.snapshot
+    FEED_MODE = options.feed
+    if options.profile:
+        profile(run_command, options)
+    else:
+        run_command(options)
+    if options.stats:
+        save_stats(options.stats)
+
+
+def run_command(options):
+    ''' (argparse.Namespace) -> NoneType
+
+    Run the command main was given, with its options.
+    '''
+    if options.command == "show":
+        # The changes waiting in the log are part of the data too
+        csv_header, csv_data = read_current()
+        # Let's print the header of our csv file, which we are keeping
+        # separate from our database, as it not a record.
+        print(csv_header)
+        # Now, let's print the database to see how it is set up:
+        # The database is a list of records, where every record represents
+        # a row. The order of the fields of a record is the same as the
+        # order of the database headers
+        print([list(record) for record in csv_data])
+    elif options.command == "table":
+        columns = None
+        if options.columns:
+            columns = options.columns.split(",")
+        get_csv(None, options.limit, options.offset, columns,
+                options.auto_size)
+    elif options.command == "price":
+        print(get_item_price(options.item, options.colour))
+    elif options.command == "quantity":
+        print(get_item_quantity(options.item, options.colour))
+    elif options.command == "colour":
+        print(get_items_of_colour(options.colour))
+    elif options.command == "colours":
+        print(get_colours_of_item(options.item))
+    elif options.command == "low-stock":
+        print(low_in_stock())
+    elif options.command == "totals":
+        print(json.dumps(get_totals(), indent=2))
+    elif options.command == "buy":
+        print(can_i_buy(options.budget))
+    elif options.command == "import":
+        result = import_items(options.feed)
+        for line, error in result["errors"]:
+            print("Line " + str(line) + ": " + error)
+        print(str(result["inserted"]) + " inserted, " + str(result["updated"])
+              + " updated, " + str(result["rejected"]) + " rejected")
+    elif options.command == "feed":
+        for event in read_feed(options.after):
+            print(json.dumps(event))
 
 
 #########################################################################
@@ -351,14 +2853,8 @@ def get_csv():
 #########################################################################
 #########################################################################
 # Find the global code below:
-# Read the data just so we can see it
-csv_header, csv_data = read_csv()
-# Let's print the header of our csv file, which we are keeping separate from
-# our database, as it not a record.
-print(csv_header)
-# Now, let's print the database to see how it is set up:
-# The database is a list inside a list, which means that every item of
-# the database list represent a row
-# Every row is also represented by a list, where the order of the elements
-# is the same as the order of the database headers
-print(csv_data)
+# Importing the store (from another program, a worker or a test) doesn't
+# read anything: the file is only read the first time a function needs it.
+# Running this file shows the data (see main).
+if __name__ == "__main__":
+    main()
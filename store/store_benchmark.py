@@ -0,0 +1,375 @@
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import store
+
+# How many records to try, unless we are told otherwise
+SIZES = [1000, 10000, 100000]
+# Which operations to time, unless we are told otherwise
+OPERATIONS = ["get_item_price", "get_item_quantity", "update_price",
+              "purchase_items", "get_items_of_colour", "low_in_stock",
+              "get_csv", "can_i_buy", "mixed"]
+
+
+def make_catalog(file_name, size, categories=10, colours=20, seed=0):
+    ''' (str, int, int, int, int) -> list
+
+    Write a made up store file_name with size records spread over the given
+    number of categories and colours. Return the (name, colour) of every
+    record.
+    '''
+    generator = random.Random(seed)
+    colour_names = ["colour" + str(number) for number in range(colours)]
+    # Every name comes in every colour, so we need size / colours names
+    names = ["item" + str(number) for number in range(size // colours + 1)]
+    keys = [(name, colour) for name in names for colour in colour_names][:size]
+    records = [["category" + str(generator.randrange(categories)), name,
+                colour, generator.randint(1, 100), generator.randint(0, 200)]
+               for name, colour in keys]
+    # The store keeps its file sorted by category
+    records.sort(key=lambda k: k[0])
+    with open(file_name, 'w', newline="") as writer_file:
+        writer = csv.writer(writer_file)
+        writer.writerow(["Category", "Name", "Color", "Price", "Quantity"])
+        writer.writerows(records)
+    return keys
+
+
+def percentile(times, percent):
+    ''' (list, int) -> float
+
+    Return the time that percent% of the sorted times are under.
+    '''
+    position = min(len(times) - 1, int(len(times) * percent / 100))
+    return times[position]
+
+
+def measure(operation, repeat, prepare=None):
+    ''' (function, int, function) -> dict
+
+    Call operation repeat times and return its latency percentiles (in
+    milliseconds) and how many calls per second it did. Then call it once
+    more to find the most memory (in KB) a call uses at once. If prepare is
+    given, it is called (without being timed) before every call, so every
+    call, including the one whose memory is traced, starts the same way.
+    '''
+    times = []
+    total = 0.0
+    for count in range(repeat):
+        if prepare is not None:
+            prepare()
+        before = time.perf_counter()
+        operation()
+        took = time.perf_counter() - before
+        times.append(took * 1000)
+        total += took
+    # Tracing memory makes everything slower, so we don't do it while timing
+    if prepare is not None:
+        prepare()
+    tracemalloc.start()
+    operation()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times.sort()
+    return {"calls": repeat,
+            "p50_ms": percentile(times, 50),
+            "p90_ms": percentile(times, 90),
+            "p99_ms": percentile(times, 99),
+            "max_ms": times[-1],
+            "ops_per_s": repeat / total if total else 0.0,
+            "peak_kb": peak / 1024}
+
+
+def make_operations(keys, generator, cart_size):
+    ''' (list, random.Random, int) -> dict
+
+    Return a function for every operation we know how to time. Each function
+    calls the store with a random record.
+    '''
+    def pick():
+        return generator.choice(keys)
+
+    def get_price():
+        store.get_item_price(*pick())
+
+    def get_quantity():
+        store.get_item_quantity(*pick())
+
+    def update_price():
+        name, colour = pick()
+        store.update_price(name, colour, generator.randint(1, 100))
+
+    def purchase():
+        name, colour = pick()
+        store.purchase_items(name, colour, 1)
+
+    def items_of_colour():
+        store.get_items_of_colour(pick()[1])
+
+    def can_i_buy():
+        # can_i_buy asks for the shopping list with input(), so we answer
+        # for the user: cart_size lines, then STOP, then Yes
+        answers = [name + " " + colour + " 1"
+                   for name, colour in generator.sample(keys, cart_size)]
+        answers = iter(answers + ["STOP", "Yes"])
+        store.input = lambda prompt: next(answers)
+        try:
+            store.can_i_buy(10 ** 9)
+        except ValueError:
+            # Some item was out of stock, that is a normal answer too
+            pass
+        finally:
+            del store.input
+
+    def mixed():
+        # Most calls to a store are questions, some are sales
+        if generator.random() < 0.9:
+            get_price()
+        else:
+            purchase()
+
+    return {"get_item_price": get_price,
+            "get_item_quantity": get_quantity,
+            "update_price": update_price,
+            "purchase_items": purchase,
+            "get_items_of_colour": items_of_colour,
+            "low_in_stock": store.low_in_stock,
+            "get_csv": store.get_csv,
+            "can_i_buy": can_i_buy,
+            "mixed": mixed}
+
+
+def load_inventory():
+    ''' () -> NoneType
+
+    Load the store's inventory from scratch.
+    '''
+    store.use_inventory(None)
+    store.get_inventory()
+
+
+def forget_records():
+    ''' () -> NoneType
+
+    Forget the store's inventory and the records read_csv keeps, so the
+    next load really reads the file again.
+    '''
+    store.use_inventory(None)
+    store._csv_cache.clear()
+
+
+def run(sizes, operations, repeat=100, categories=10, colours=20,
+        cart_size=10, seed=0):
+    ''' (list, list, int, int, int, int, int) -> list
+
+    Time every operation against a made up store of every size, and return
+    one result (a dict) per size and operation. The store's current modes
+    (JOURNAL_MODE, STREAMING_MODE, LOCKING_MODE, SNAPSHOT_MODE) are used.
+    '''
+    results = []
+    old_file_name = store.FILE_NAME
+    folder = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            store.FILE_NAME = os.path.join(folder, "store_items.csv")
+            keys = make_catalog(store.FILE_NAME, size, categories, colours,
+                                seed)
+            generator = random.Random(seed)
+            functions = make_operations(keys, generator, min(cart_size, size))
+            # Loading the store is a cost of its own
+            if store.SNAPSHOT_MODE:
+                # Write the snapshot first, so the load we time reads it
+                # instead of parsing the csv file and writing the snapshot
+                store.read_csv()
+            load = measure(load_inventory, 1, forget_records)
+            results.append(dict(load, operation="load", size=size))
+            for operation in operations:
+                # The store prints a message on every change, we don't want
+                # to time the terminal
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = measure(functions[operation], repeat)
+                result["operation"] = operation
+                result["size"] = size
+                results.append(result)
+            # Forget this store before making the next one
+            store.use_inventory(None)
+    finally:
+        store.FILE_NAME = old_file_name
+        store.use_inventory(None)
+        shutil.rmtree(folder)
+    return results
+
+
+def same_inventory(inventory, loaded):
+    ''' (store.Inventory, store.Inventory) -> NoneType
+
+    Raise an AssertionError if the inventory, after the changes it made, is
+    not exactly like loaded, which was just loaded from the same file.
+    '''
+    # The records, in the order of the file
+    assert inventory.rows() == loaded.rows()
+    assert inventory.records == loaded.records
+    # Every sort key is in order and belongs to the record in its place
+    assert inventory.sort_keys == sorted(inventory.sort_keys)
+    assert inventory.sort_keys == [
+        (record.category, inventory.sequence[record.key()])
+        for record in inventory.order]
+    # The indexes and totals that every change keeps up to date
+    for index in ("by_colour", "by_name", "by_category", "by_quantity",
+                  "stock"):
+        assert getattr(inventory, index) == getattr(loaded, index), index
+    assert inventory.low_stock(store.MIN_STOCK) == loaded.low_stock(
+        store.MIN_STOCK)
+    # Where the rows are in the file, if the inventory thinks it knows
+    if inventory.offsets is not None:
+        loaded.find_offsets()
+        assert inventory.offsets == loaded.offsets
+
+
+def check_inventory(size=200, changes=300, journal=False, in_place=True,
+                    seed=0):
+    ''' (int, int, bool, bool, int) -> NoneType
+
+    Make random changes to a store.Inventory of a made up store of size
+    records: purchases, new prices, new records, records that move to another
+    category, removed records, add_many and batches (some of which fail and
+    must change nothing). After every change, load the file again and check
+    that it gives exactly the same inventory (see same_inventory). Raise an
+    AssertionError if it doesn't.
+    '''
+    folder = tempfile.mkdtemp()
+    try:
+        file_name = os.path.join(folder, "store_items.csv")
+        keys = make_catalog(file_name, size, seed=seed)
+        generator = random.Random(seed)
+        inventory = store.Inventory(file_name, journal, False, in_place)
+        for number in range(changes):
+            name, colour = generator.choice(keys)
+            category = "category" + str(generator.randrange(12))
+            new_name = "new" + str(number)
+            choice = generator.random()
+            if choice < 0.25:
+                # A few items at a time, so the quantity mostly keeps its
+                # number of digits and the row can be written in place
+                inventory.purchase(name, colour, generator.randint(0, 3))
+            elif choice < 0.4:
+                inventory.set_price(name, colour, generator.randint(10, 99))
+            elif choice < 0.5:
+                # The same category, or a new one
+                inventory.add(category, name, colour, 5, 100)
+            elif choice < 0.6:
+                inventory.add(category, new_name, colour, 5, 100)
+                keys.append((new_name, colour))
+            elif choice < 0.7:
+                inventory.remove(name, colour)
+            elif choice < 0.78:
+                inventory.add_many([store.StoreItem(category, name, colour, 7,
+                                                    30),
+                                    store.StoreItem(category, new_name,
+                                                    colour, 7, 30)])
+                keys.append((new_name, colour))
+            elif choice < 0.8:
+                inventory.compact()
+            else:
+                before = inventory.rows()
+                try:
+                    with inventory.batch():
+                        inventory.purchase(name, colour, 1)
+                        inventory.add(category, new_name, colour, 5, 5)
+                        # Half of the batches buy more than there is
+                        if generator.random() < 0.5:
+                            record = generator.choice(before)
+                            inventory.purchase(record.name, record.colour,
+                                               record.quantity + 1)
+                except ValueError:
+                    assert inventory.rows() == before
+                else:
+                    keys.append((new_name, colour))
+            same_inventory(inventory, store.Inventory(file_name, journal))
+    finally:
+        shutil.rmtree(folder)
+
+
+def print_results(results):
+    ''' (list) -> NoneType
+
+    Print the results of run in a table.
+    '''
+    columns = ["size", "operation", "calls", "p50_ms", "p90_ms", "p99_ms",
+               "max_ms", "ops_per_s", "peak_kb"]
+    print("".join('{:>20}'.format(column) for column in columns))
+    for result in results:
+        row = ""
+        for column in columns:
+            value = result[column]
+            if isinstance(value, float):
+                value = '{:.3f}'.format(value)
+            row += '{:>20}'.format(value)
+        print(row)
+
+
+def main(arguments=None):
+    ''' (list) -> NoneType
+
+    Run the benchmark from the command line.
+    '''
+    parser = argparse.ArgumentParser(
+        description="Time the store's functions on made up stores.")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)),
+                        help="comma separated numbers of records")
+    parser.add_argument("--operations", default=",".join(OPERATIONS),
+                        help="comma separated operations to time")
+    parser.add_argument("--repeat", type=int, default=100,
+                        help="how many times to call every operation")
+    parser.add_argument("--categories", type=int, default=10)
+    parser.add_argument("--colours", type=int, default=20)
+    parser.add_argument("--cart-size", type=int, default=10,
+                        help="how many lines every can_i_buy cart has")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--journal", action="store_true",
+                        help="use the store's journal mode")
+    parser.add_argument("--streaming", action="store_true",
+                        help="use the store's streaming mode")
+    parser.add_argument("--locking", action="store_true",
+                        help="use the store's locking mode")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="use the store's snapshot mode")
+    parser.add_argument("--json", help="also save the results in this file")
+    parser.add_argument("--check", action="store_true",
+                        help="instead of timing, check that random changes "
+                             "give the same inventory as loading the file "
+                             "again (see check_inventory)")
+    options = parser.parse_args(arguments)
+    if options.check:
+        # Whole file, rows written in place, and journal mode
+        for journal, in_place in ((False, False), (False, True),
+                                  (True, False)):
+            check_inventory(journal=journal, in_place=in_place,
+                            seed=options.seed)
+        print("ok")
+        return
+    store.JOURNAL_MODE = options.journal
+    store.STREAMING_MODE = options.streaming
+    store.LOCKING_MODE = options.locking
+    store.SNAPSHOT_MODE = options.snapshot
+    results = run([int(size) for size in options.sizes.split(",")],
+                  options.operations.split(","), options.repeat,
+                  options.categories, options.colours, options.cart_size,
+                  options.seed)
+    print_results(results)
+    if options.json:
+        with open(options.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,653 @@
+import contextlib
+import csv
+import os
+
+import store
+
+# NumPy is optional, the rest of the store works without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The arrays that hold the records, one element per row
+COLUMNS = ("category", "name", "colour", "price", "quantity", "live")
+# The column of codes -> the sorted strings its codes are positions in
+NAMES = {"category": "category_names", "name": "item_names",
+         "colour": "colour_names"}
+
+
+class ColumnarInventory:
+    ''' The store's database, stored by column.
+
+    It has the same methods as store.Inventory, so it can be plugged into the
+    store with store.use_inventory (see use_columnar), and it also answers
+    questions over the whole database, like stock_value or change_prices.
+
+    Instead of one object per record, every column is one NumPy array:
+     - category, name and colour are arrays of codes (ints). The code is the
+       position of the string in category_names, item_names or colour_names,
+       which are kept sorted.
+     - price and quantity are arrays of ints.
+     - live is False for the rows of removed records (they are only dropped
+       when the file is written again) and for the free rows at the end.
+    Record number i is made of the i-th element of every array, so questions
+    like "which records have less than 50 items?" become one comparison over
+    a whole array instead of a Python loop.
+
+    A record keeps its row when it changes. A new record, or one that moves
+    to another category, takes a new row at the end, so the live rows sorted
+    by category (keeping their order within a category) are in the order of
+    the file, like in store.Inventory.
+
+    Changes are written to the csv file like store.Inventory does without
+    locking: the whole file, or the log in journal mode.
+    '''
+
+    def __init__(self, file_name=None, journal=False):
+        ''' (ColumnarInventory, str, bool) -> NoneType
+
+        Create a columnar inventory for file_name (store.FILE_NAME if no
+        file_name is given) and load its records. If journal is True,
+        changes are appended to a log instead of rewriting the whole file
+        (see store.Inventory).
+
+        REQ: file_name has to be a valid .csv file with a header and NumPy
+        must be installed.
+        '''
+        if numpy is None:
+            raise ImportError("The columnar inventory needs NumPy installed")
+        if file_name is None:
+            file_name = store.FILE_NAME
+        self.file_name = file_name
+        self.journal = journal
+        # How many changes are in the log, waiting to be compacted
+        self.journal_size = 0
+        # While a batch is open, changes wait here instead of being written,
+        # and so do their events (see store.publish)
+        self.pending = None
+        self.events = []
+        # What the csv file and its log looked like when we last read or
+        # wrote them
+        self.signature = None
+        self.load()
+
+    def load(self):
+        ''' (ColumnarInventory) -> NoneType
+
+        (Re)load every record from the csv file and its log.
+        '''
+        self.signature = self.current_signature()
+        self.header, records = store.read_current(self.file_name)
+        self.build(records)
+        # The changes in the log are kept there until it is compacted
+        self.journal_size = 0
+        log_name = store.journal_name(self.file_name)
+        if os.path.exists(log_name):
+            with open(log_name, newline="") as log_file:
+                self.journal_size = sum(1 for change in csv.reader(log_file))
+
+    def build(self, records):
+        ''' (ColumnarInventory, list) -> NoneType
+
+        Build the columns from a list of records (store.StoreItem), in the
+        order of the file.
+        '''
+        self.category_names, categories = encode([r.category for r in records])
+        self.item_names, names = encode([r.name for r in records])
+        self.colour_names, colours = encode([r.colour for r in records])
+        self.category = numpy.array(categories, dtype=numpy.int32)
+        self.name = numpy.array(names, dtype=numpy.int32)
+        self.colour = numpy.array(colours, dtype=numpy.int32)
+        self.price = numpy.array([r.price for r in records], dtype=numpy.int64)
+        self.quantity = numpy.array([r.quantity for r in records],
+                                    dtype=numpy.int64)
+        self.live = numpy.ones(len(records), dtype=bool)
+        # How many rows are used, the rest are free for new records
+        self.size = len(records)
+        # To find one record we still want a single lookup by name and colour
+        self.positions = {r.key(): i for i, r in enumerate(records)}
+
+    def current_signature(self):
+        ''' (ColumnarInventory) -> tuple
+
+        Return the signatures (see store.file_signature) of the csv file and
+        its log.
+        '''
+        return (store.file_signature(self.file_name),
+                store.file_signature(store.journal_name(self.file_name)))
+
+    def is_stale(self):
+        ''' (ColumnarInventory) -> bool
+
+        Return True if somebody else changed the csv file or its log since we
+        last read or wrote them.
+        '''
+        return self.current_signature() != self.signature
+
+    def __len__(self):
+        ''' (ColumnarInventory) -> int
+
+        Return how many records there are.
+        '''
+        return len(self.positions)
+
+    def code(self, names, value):
+        ''' (ColumnarInventory, numpy.ndarray, str) -> int
+
+        Return the code of value in names, or -1 if it is not there (-1
+        never matches any code, so masks built from it are all False).
+        '''
+        position = numpy.searchsorted(names, value)
+        if position < len(names) and names[position] == value:
+            return int(position)
+        return -1
+
+    def new_code(self, column, value):
+        ''' (ColumnarInventory, str, str) -> int
+
+        Return the code of value in the column ("category", "name" or
+        "colour"), adding value to the column's names if it is not there.
+        '''
+        names = getattr(self, NAMES[column])
+        position = self.code(names, value)
+        if position >= 0:
+            return position
+        # The names stay sorted, so every code from this position on moves
+        # up by one
+        position = int(numpy.searchsorted(names, value))
+        setattr(self, NAMES[column], numpy.insert(names, position, value))
+        codes = getattr(self, column)
+        codes[codes >= position] += 1
+        return position
+
+    def append(self, record):
+        ''' (ColumnarInventory, store.StoreItem) -> int
+
+        Put the record in a new row at the end and return the row.
+        '''
+        # Make twice as many rows when there are no free ones left, so adding
+        # records one by one doesn't copy the columns every time
+        if self.size == len(self.live):
+            rows = max(16, 2 * len(self.live))
+            for column in COLUMNS:
+                old = getattr(self, column)
+                new = numpy.zeros(rows, dtype=old.dtype)
+                new[:len(old)] = old
+                setattr(self, column, new)
+        row = self.size
+        self.size += 1
+        self.category[row] = self.new_code("category", record.category)
+        self.name[row] = self.new_code("name", record.name)
+        self.colour[row] = self.new_code("colour", record.colour)
+        self.price[row] = record.price
+        self.quantity[row] = record.quantity
+        self.live[row] = True
+        return row
+
+    def in_order(self, rows):
+        ''' (ColumnarInventory, numpy.ndarray) -> numpy.ndarray
+
+        Return the rows sorted in the order of the file.
+        '''
+        # The category names are sorted, so sorting by code is sorting by
+        # category. lexsort sorts by the last key first.
+        return rows[numpy.lexsort((rows, self.category[rows]))]
+
+    def find(self, mask):
+        ''' (ColumnarInventory, numpy.ndarray) -> numpy.ndarray
+
+        Return the rows of the records the mask is True for, in the order of
+        the file.
+        '''
+        return self.in_order(numpy.flatnonzero(mask & self.live))
+
+    def records(self, rows):
+        ''' (ColumnarInventory, numpy.ndarray) -> list
+
+        Return the records in the rows, as store.StoreItems.
+        '''
+        return [store.StoreItem(*record) for record in zip(
+            self.category_names[self.category[rows]].tolist(),
+            self.item_names[self.name[rows]].tolist(),
+            self.colour_names[self.colour[rows]].tolist(),
+            self.price[rows].tolist(), self.quantity[rows].tolist())]
+
+    def describe(self, rows):
+        ''' (ColumnarInventory, numpy.ndarray) -> list
+
+        Return "colour name" for the records in the rows.
+        '''
+        colours = self.colour_names[self.colour[rows]]
+        names = self.item_names[self.name[rows]]
+        return [colour + " " + name for colour, name in zip(colours, names)]
+
+    def rows(self):
+        ''' (ColumnarInventory) -> list
+
+        Return every record, sorted by category (the order used in the file).
+        '''
+        return self.records(self.find(self.live))
+
+    def get_record(self, item, colour):
+        ''' (ColumnarInventory, str, str) -> store.StoreItem
+
+        Return the record for the item and its colour, or None if there is
+        no such record.
+        '''
+        row = self.positions.get((item, colour))
+        if row is not None:
+            return self.records([row])[0]
+
+    def get_price(self, item, colour):
+        ''' (ColumnarInventory, str, str) -> int
+
+        Return the price of the item and its colour, or None if there is
+        no such record.
+        '''
+        row = self.positions.get((item, colour))
+        if row is not None:
+            return int(self.price[row])
+
+    def get_quantity(self, item, colour):
+        ''' (ColumnarInventory, str, str) -> int
+
+        Return how many of the item and its colour are in stock, or None if
+        there is no such record.
+        '''
+        row = self.positions.get((item, colour))
+        if row is not None:
+            return int(self.quantity[row])
+
+    def low_stock(self, min_stock):
+        ''' (ColumnarInventory, int) -> list
+
+        Return "colour name" for every record with less than min_stock items,
+        in the order of the file.
+        '''
+        return self.describe(self.find(self.quantity < min_stock))
+
+    def items_of_colour(self, colour):
+        ''' (ColumnarInventory, str) -> list
+
+        Return the names of all the items that are that colour.
+        '''
+        rows = self.find(self.colour == self.code(self.colour_names, colour))
+        return self.item_names[self.name[rows]].tolist()
+
+    def colours_of_item(self, item):
+        ''' (ColumnarInventory, str) -> list
+
+        Return all the colours of the item.
+        '''
+        rows = self.find(self.name == self.code(self.item_names, item))
+        return self.colour_names[self.colour[rows]].tolist()
+
+    def items_in_category(self, category):
+        ''' (ColumnarInventory, str) -> list
+
+        Return every record in the category.
+        '''
+        return self.records(self.find(self.mask(category)))
+
+    def totals(self, min_stock):
+        ''' (ColumnarInventory, int) -> dict
+
+        Return the totals of the records (see store.count_totals) and how
+        many records have less than min_stock items ("low_stock").
+        '''
+        quantity = self.quantity[self.live]
+        value = self.price[self.live] * quantity
+        totals = {"records": len(quantity), "units": int(quantity.sum()),
+                  "value": int(value.sum())}
+        for group, column in (("categories", "category"),
+                              ("colours", "colour")):
+            codes = getattr(self, column)[self.live]
+            names = getattr(self, NAMES[column])
+            # bincount adds up every record into its category's (or colour's)
+            # slot
+            records = numpy.bincount(codes, minlength=len(names))
+            units = numpy.bincount(codes, weights=quantity,
+                                   minlength=len(names))
+            values = numpy.bincount(codes, weights=value, minlength=len(names))
+            totals[group] = {names[code]: {"records": int(records[code]),
+                                           "units": int(units[code]),
+                                           "value": int(values[code])}
+                             for code in numpy.flatnonzero(records)}
+        totals["low_stock"] = int(numpy.count_nonzero(quantity < min_stock))
+        return totals
+
+    def cart_total(self, cart):
+        ''' (ColumnarInventory, list) -> int
+
+        Given a cart (a list of [item, colour, quantity]), return how much
+        it costs.
+
+        REQ: every item and colour in the cart exists in the database.
+        '''
+        rows = numpy.array([self.positions[(line[0], line[1])]
+                            for line in cart], dtype=numpy.int64)
+        amounts = numpy.array([int(line[2]) for line in cart],
+                              dtype=numpy.int64)
+        # Take every price we need at once and multiply it by its amount
+        return int(numpy.dot(self.price[rows], amounts)) if len(rows) else 0
+
+    def mask(self, category=None, colour=None):
+        ''' (ColumnarInventory, str, str) -> numpy.ndarray
+
+        Return a mask that is True for the records in the category and of the
+        colour. Leave category or colour as None to not filter on it.
+        '''
+        mask = self.live.copy()
+        if category is not None:
+            mask &= self.category == self.code(self.category_names, category)
+        if colour is not None:
+            mask &= self.colour == self.code(self.colour_names, colour)
+        return mask
+
+    def stock_value(self):
+        ''' (ColumnarInventory) -> dict
+
+        Return how much the stock of every category is worth.
+        '''
+        return {category: total["value"] for category, total
+                in self.totals(0)["categories"].items()}
+
+    def apply(self, change, events=None):
+        ''' (ColumnarInventory, list, list) -> bool
+
+        Apply a change (see store.Inventory.apply) to the columns. If events
+        is given, the event of the change (see store.make_event) is added to
+        it. Return True if the record the change is about was found.
+        '''
+        operation = change[0]
+        key = store.change_key(change)
+        row = self.positions.get(key)
+        if operation == "add":
+            record = store.StoreItem(change[1], change[2], change[3],
+                                     change[4], change[5])
+            old_record = None
+            if row is not None:
+                old_record = self.records([row])[0]
+            if old_record is not None and \
+                    old_record.category == record.category:
+                # The record keeps its row, and its place in the file
+                self.price[row] = record.price
+                self.quantity[row] = record.quantity
+            else:
+                if row is not None:
+                    self.live[row] = False
+                self.positions[key] = self.append(record)
+            if events is not None:
+                events.append(store.make_event(change, old_record, record))
+            return True
+        if row is None:
+            return False
+        if events is not None:
+            old_record = self.records([row])[0]
+        if operation == "remove":
+            self.live[row] = False
+            del self.positions[key]
+        elif operation == "price":
+            self.price[row] = int(change[3])
+        elif operation == "purchase":
+            self.quantity[row] -= int(change[3])
+        if events is not None:
+            new_record = None
+            if operation != "remove":
+                new_record = self.records([row])[0]
+            events.append(store.make_event(change, old_record, new_record))
+        return True
+
+    def change(self, change):
+        ''' (ColumnarInventory, list) -> bool
+
+        Apply the change (see apply) and, if its record was found, write it
+        (see write_changes). Return True if the record was found.
+        '''
+        events = None
+        if store.feed_enabled():
+            events = []
+        if not self.apply(change, events):
+            return False
+        self.commit([change], events)
+        return True
+
+    def commit(self, changes, events=None):
+        ''' (ColumnarInventory, list, list) -> NoneType
+
+        Write the changes, which were already applied to the columns, and
+        publish their events. Inside a batch, they wait for the end of the
+        batch.
+        '''
+        if self.pending is not None:
+            self.pending.extend(changes)
+            self.events.extend(events or ())
+        else:
+            self.write_changes(changes, events)
+
+    def write_changes(self, changes, events=None):
+        ''' (ColumnarInventory, list, list) -> NoneType
+
+        Write the list of changes to the log (in journal mode) or save the
+        whole file once. Then publish their events, if they are given (see
+        store.publish).
+        '''
+        if not self.journal:
+            self.save()
+        else:
+            with open(store.journal_name(self.file_name), 'a',
+                      newline="") as log_file:
+                csv.writer(log_file).writerows(changes)
+            self.journal_size += len(changes)
+            self.signature = self.current_signature()
+            # Don't let the log grow forever, replaying it also takes time
+            if self.journal_size >= store.COMPACT_AFTER:
+                self.save()
+        if events:
+            store.publish(self.file_name, events)
+
+    def save(self):
+        ''' (ColumnarInventory) -> NoneType
+
+        Write every record back to the csv file and forget the log.
+        '''
+        records = self.rows()
+        store._write_rows(self.file_name, self.header, records)
+        log_name = store.journal_name(self.file_name)
+        if os.path.exists(log_name):
+            os.remove(log_name)
+        self.journal_size = 0
+        self.signature = self.current_signature()
+        # The rows of removed records can go now that the file is written
+        self.build(records)
+
+    def compact(self):
+        ''' (ColumnarInventory) -> NoneType
+
+        Fold every change in the log back into the csv file.
+        '''
+        self.save()
+
+    def check(self, changes):
+        ''' (ColumnarInventory, list) -> NoneType
+
+        Raise a ValueError if any of the changes left a record with a
+        negative quantity or a price that is not greater than 0.
+        '''
+        for change in changes:
+            record = self.get_record(*store.change_key(change))
+            if record is not None:
+                store.check_record(record)
+
+    @contextlib.contextmanager
+    def batch(self):
+        ''' (ColumnarInventory) -> context manager
+
+        Group many changes so they are checked together and written only
+        once, when the with block ends (see store.Inventory.batch). If any
+        change leaves a record with a negative quantity or a price that is
+        not greater than 0, or if the with block raises an error, none of the
+        changes are kept and the error is raised.
+        '''
+        # A batch inside a batch is just part of the outer one
+        if self.pending is not None:
+            yield self
+            return
+        # Copying whole arrays is quick, so we keep a copy of everything to
+        # go back to if anything fails
+        backup = {column: getattr(self, column).copy()
+                  for column in COLUMNS + tuple(NAMES.values())}
+        backup_size = self.size
+        backup_positions = dict(self.positions)
+        self.pending = []
+        self.events = []
+        try:
+            yield self
+            self.check(self.pending)
+        except BaseException:
+            for column, values in backup.items():
+                setattr(self, column, values)
+            self.size = backup_size
+            self.positions = backup_positions
+            self.pending = None
+            self.events = []
+            raise
+        changes = self.pending
+        events = self.events
+        self.pending = None
+        self.events = []
+        if changes:
+            self.write_changes(changes,
+                               events if store.feed_enabled() else None)
+
+    def add(self, category, name, colour, price, quantity):
+        ''' (ColumnarInventory, str, str, str, int, int) -> NoneType
+
+        Add a new record and write the change. If the record already exists,
+        it is replaced.
+        '''
+        self.change(["add", category, name, colour, price, quantity])
+
+    def add_many(self, records):
+        ''' (ColumnarInventory, list) -> NoneType
+
+        Add every record (a store.StoreItem) in the list, replacing the
+        records that already exist, and write the changes all at once.
+        '''
+        with self.batch():
+            for record in records:
+                self.add(record.category, record.name, record.colour,
+                         record.price, record.quantity)
+
+    def remove(self, item, colour):
+        ''' (ColumnarInventory, str, str) -> bool
+
+        Remove the record for the item and its colour and write the change.
+        Return True if the record was found.
+        '''
+        return self.change(["remove", item, colour])
+
+    def set_price(self, item, colour, new_price):
+        ''' (ColumnarInventory, str, str, int) -> bool
+
+        Replace the price of the item and its colour with new_price and
+        write the change. Return True if the record was found.
+        '''
+        return self.change(["price", item, colour, new_price])
+
+    def purchase(self, item, colour, items_bought):
+        ''' (ColumnarInventory, str, str, int) -> bool
+
+        Take items_bought out of the stock of the item and its colour and
+        write the change. Return True if the record was found.
+        '''
+        return self.change(["purchase", item, colour, items_bought])
+
+    def change_prices(self, percent, category=None, colour=None):
+        ''' (ColumnarInventory, int, str, str) -> int
+
+        Change the price of every record in the category and of the colour
+        by percent (10 is 10% more expensive, -10 is 10% cheaper), rounding
+        to the closest dollar but never below 1, and write the changes all
+        at once. Return how many records were in the category and of the
+        colour.
+        '''
+        rows = self.find(self.mask(category, colour))
+        new_prices = numpy.rint(self.price[rows] * (100 + percent) / 100)
+        new_prices = numpy.maximum(new_prices, 1).astype(numpy.int64)
+        # Only the prices that are different are changes
+        different = new_prices != self.price[rows]
+        changed = rows[different]
+        new_prices = new_prices[different]
+        events = None
+        if store.feed_enabled():
+            old_records = self.records(changed)
+        self.price[changed] = new_prices
+        changes = [["price", name, colour, price]
+                   for name, colour, price in zip(
+                       self.item_names[self.name[changed]].tolist(),
+                       self.colour_names[self.colour[changed]].tolist(),
+                       new_prices.tolist())]
+        if store.feed_enabled():
+            events = [store.make_event(change, old, new) for change, old, new
+                      in zip(changes, old_records, self.records(changed))]
+        if changes:
+            self.commit(changes, events)
+        return len(rows)
+
+    def save_prices(self, inventory=None):
+        ''' (ColumnarInventory, store.Inventory) -> int
+
+        Copy every price that is different in the columns into another
+        inventory (the store's inventory if none is given), writing it once.
+        Return how many prices were copied.
+        '''
+        if inventory is None:
+            inventory = store.get_inventory()
+        changed = 0
+        with inventory.batch():
+            for (item, colour), position in self.positions.items():
+                new_price = int(self.price[position])
+                if inventory.get_price(item, colour) != new_price:
+                    inventory.set_price(item, colour, new_price)
+                    changed += 1
+        return changed
+
+
+def encode(values):
+    ''' (list) -> (numpy.ndarray, list)
+
+    Given a list of strings, return the sorted distinct strings and, for
+    every value, its position (code) in them.
+    '''
+    names, codes = numpy.unique(numpy.array(values, dtype=object),
+                                return_inverse=True)
+    return (names, codes.reshape(-1))
+
+
+def load_columns(file_name=None):
+    ''' (str) -> ColumnarInventory
+
+    Read the csv file_name (store.FILE_NAME if no file_name is given) into
+    a ColumnarInventory, with the changes waiting in its log (see
+    store.read_current).
+
+    REQ: file_name has to be a valid .csv file with a header and NumPy must
+    be installed.
+    '''
+    return ColumnarInventory(file_name)
+
+
+def use_columnar(file_name=None):
+    ''' (str) -> ColumnarInventory
+
+    Make every function of the store use a ColumnarInventory of file_name
+    (store.FILE_NAME if no file_name is given), in the store's current
+    JOURNAL_MODE. Return the ColumnarInventory.
+
+    REQ: NumPy must be installed.
+    '''
+    inventory = ColumnarInventory(file_name, store.JOURNAL_MODE)
+    store.use_inventory(inventory)
+    return inventory
@@ -0,0 +1,356 @@
+import argparse
+import collections
+import heapq
+import itertools
+import math
+import time
+
+import store
+
+# How many items to order up to when no rule says otherwise
+TARGET_STOCK = 100
+# How many days of purchases are used to find how fast an item sells
+HISTORY_DAYS = 30
+SECONDS_PER_DAY = 24 * 60 * 60
+# Once more than this part of the queue is entries we threw away, the queue
+# is built again without them
+MAX_STALE = 0.5
+
+
+class ReorderPlanner:
+    ''' Which records of the store need to be ordered again, most urgent
+    first.
+
+    A record needs to be ordered when its quantity is below its threshold,
+    and we order enough to bring it back up to its target. The threshold
+    and target of a record come from the first of these that has one:
+     - a rule for the item and its colour (see set_item_rule)
+     - a rule for its category (see set_category_rule)
+     - the defaults: store.MIN_STOCK and TARGET_STOCK
+
+    The records that need to be ordered are kept in a priority queue (a
+    heap), ordered by either:
+     - "shortfall": how many items are missing to reach the target, the
+       most missing first
+     - "cover": days of cover, how many days the quantity left lasts at the
+       speed the item sold over the last HISTORY_DAYS days, the fewest
+       first (items that didn't sell come last, by shortfall)
+
+    The planner subscribes to the store's events (see store.subscribe), so
+    every change only moves its own record in the queue instead of going
+    through the whole database again. The days of cover of a record are
+    worked out again when it changes; call rebuild to bring all of them up
+    to date as old purchases stop counting.
+    '''
+
+    def __init__(self, inventory=None, by="shortfall"):
+        ''' (ReorderPlanner, object, str) -> NoneType
+
+        Create a planner for the inventory (the store's inventory if none is
+        given), ordering the records by "shortfall" or "cover", and start
+        following its changes.
+        '''
+        if by not in ("shortfall", "cover"):
+            raise ValueError("Order by shortfall or cover, not " + repr(by))
+        if inventory is None:
+            inventory = store.get_inventory()
+        self.inventory = inventory
+        self.by = by
+        # (name, colour) -> (threshold, target), and category -> (threshold,
+        # target)
+        self.item_rules = {}
+        self.category_rules = {}
+        # (name, colour) -> [category, quantity] of every record
+        self.records = {}
+        # (name, colour) -> (time, units) of its purchases, oldest first,
+        # and how many units those purchases add up to
+        self.history = {}
+        self.sold = {}
+        # The sequence number of the last event we saw (see store.publish)
+        self.seq = 0
+        # The queue: a heap of entries [priority, number, key]. An entry we
+        # throw away keeps its place in the heap with its key set to None,
+        # because taking it out of the middle of the heap would be slow.
+        self.heap = []
+        # (name, colour) -> its entry in the heap, for the records that need
+        # to be ordered
+        self.entries = {}
+        self.stale = 0
+        # Every entry gets a new number, so two entries with the same
+        # priority are never compared by their keys
+        self.numbers = itertools.count()
+        self.load_history()
+        self.rebuild()
+        store.subscribe(self.update)
+
+    def close(self):
+        ''' (ReorderPlanner) -> NoneType
+
+        Stop following the store's changes.
+        '''
+        store.unsubscribe(self.update)
+
+    def load_history(self):
+        ''' (ReorderPlanner) -> NoneType
+
+        Read the purchases of the last HISTORY_DAYS days from the store's
+        feed (see store.read_feed), if there is one.
+        '''
+        if not store.FEED_MODE:
+            return
+        since = time.time() - HISTORY_DAYS * SECONDS_PER_DAY
+        for event in store.read_feed(0, self.inventory.file_name):
+            self.seq = event["seq"]
+            if event["time"] >= since:
+                self.remember_purchase(event)
+
+    def rebuild(self):
+        ''' (ReorderPlanner) -> NoneType
+
+        Build the queue again from every record of the inventory.
+        '''
+        self.records = {record.key(): [record.category, record.quantity]
+                        for record in self.inventory.rows()}
+        self.heap = []
+        self.entries = {}
+        self.stale = 0
+        for key in self.records:
+            entry = self.make_entry(key)
+            if entry is not None:
+                self.heap.append(entry)
+                self.entries[key] = entry
+        # Building the heap at once is faster than pushing every entry
+        heapq.heapify(self.heap)
+
+    def set_item_rule(self, item, colour, threshold, target):
+        ''' (ReorderPlanner, str, str, int, int) -> NoneType
+
+        Order the item in that colour when there are less than threshold
+        left, up to target.
+
+        REQ: 0 <= threshold <= target
+        '''
+        check_rule(threshold, target)
+        self.item_rules[(item, colour)] = (threshold, target)
+        self.requeue((item, colour))
+
+    def set_category_rule(self, category, threshold, target):
+        ''' (ReorderPlanner, str, int, int) -> NoneType
+
+        Order the items of the category (that have no rule of their own)
+        when there are less than threshold left, up to target.
+
+        REQ: 0 <= threshold <= target
+        '''
+        check_rule(threshold, target)
+        self.category_rules[category] = (threshold, target)
+        for key, record in self.records.items():
+            if record[0] == category:
+                self.requeue(key)
+
+    def rule(self, key):
+        ''' (ReorderPlanner, tuple) -> tuple
+
+        Return the (threshold, target) of the record key (name, colour).
+        '''
+        rule = self.item_rules.get(key)
+        if rule is None:
+            rule = self.category_rules.get(self.records[key][0])
+        if rule is None:
+            rule = (store.MIN_STOCK, TARGET_STOCK)
+        return rule
+
+    def sales_per_day(self, key, now=None):
+        ''' (ReorderPlanner, tuple, float) -> float
+
+        Return how many items of the record key (name, colour) were bought
+        per day over the last HISTORY_DAYS days.
+        '''
+        purchases = self.history.get(key)
+        if not purchases:
+            return 0.0
+        if now is None:
+            now = time.time()
+        # Forget the purchases that are too old to count
+        since = now - HISTORY_DAYS * SECONDS_PER_DAY
+        while purchases and purchases[0][0] < since:
+            self.sold[key] -= purchases.popleft()[1]
+        return self.sold[key] / HISTORY_DAYS
+
+    def days_of_cover(self, key):
+        ''' (ReorderPlanner, tuple) -> float
+
+        Return how many days the quantity of the record key (name, colour)
+        lasts at the speed it sells, or infinity if it doesn't sell.
+        '''
+        sales = self.sales_per_day(key)
+        if not sales:
+            return math.inf
+        return max(self.records[key][1], 0) / sales
+
+    def make_entry(self, key):
+        ''' (ReorderPlanner, tuple) -> list
+
+        Return a new heap entry for the record key (name, colour), or None
+        if it doesn't need to be ordered.
+        '''
+        threshold, target = self.rule(key)
+        quantity = self.records[key][1]
+        if quantity >= threshold:
+            return None
+        shortfall = target - quantity
+        # heapq gives back the smallest entry first
+        if self.by == "cover":
+            priority = (self.days_of_cover(key), -shortfall)
+        else:
+            priority = (-shortfall,)
+        return [priority, next(self.numbers), key]
+
+    def requeue(self, key):
+        ''' (ReorderPlanner, tuple) -> NoneType
+
+        Put the record key (name, colour) back in its right place in the
+        queue, or take it out if it doesn't need to be ordered anymore (or
+        was removed).
+        '''
+        old_entry = self.entries.pop(key, None)
+        if old_entry is not None:
+            old_entry[-1] = None
+            self.stale += 1
+        if key in self.records:
+            entry = self.make_entry(key)
+            if entry is not None:
+                heapq.heappush(self.heap, entry)
+                self.entries[key] = entry
+        if self.stale > MAX_STALE * len(self.heap):
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+            self.stale = 0
+
+    def remember_purchase(self, event):
+        ''' (ReorderPlanner, dict) -> NoneType
+
+        Add the items bought in a purchase event to the history.
+        '''
+        if event["op"] != "purchase" or not event["old"] or not event["new"]:
+            return
+        units = event["old"][4] - event["new"][4]
+        if units > 0:
+            key = tuple(event["key"])
+            self.history.setdefault(key, collections.deque()).append(
+                (event["time"], units))
+            self.sold[key] = self.sold.get(key, 0) + units
+
+    def update(self, event):
+        ''' (ReorderPlanner, dict) -> NoneType
+
+        Move the record of a change event (see store.publish) in the queue.
+        This is called by the store for every change.
+        '''
+        # An event we already saw in the feed
+        if store.FEED_MODE and event["seq"] <= self.seq:
+            return
+        self.seq = event["seq"]
+        self.remember_purchase(event)
+        key = tuple(event["key"])
+        new = event["new"]
+        if new is None:
+            self.records.pop(key, None)
+        else:
+            self.records[key] = [new[0], new[4]]
+        self.requeue(key)
+
+    def catch_up(self):
+        ''' (ReorderPlanner) -> int
+
+        Apply the changes other programs made to the store since the last
+        event we saw, from the store's feed (in store.FEED_MODE). Return how
+        many events were applied.
+        '''
+        applied = 0
+        for event in store.read_feed(self.seq, self.inventory.file_name):
+            self.update(event)
+            applied += 1
+        return applied
+
+    def top(self, k):
+        ''' (ReorderPlanner, int) -> list
+
+        Return the k records that most need to be ordered, most urgent
+        first, as dicts with their name, colour, category, quantity,
+        threshold, target, how many to order and days of cover.
+
+        The queue is not changed. The smallest entry of a heap is at the
+        top, and every entry is smaller than its two children, so we only
+        look at the children of the entries we already took: about k log k
+        steps, no matter how many records there are.
+        '''
+        plan = []
+        # (priority, number, position in the heap) of the entries we can
+        # take next
+        frontier = []
+        if self.heap:
+            frontier.append((self.heap[0][0], self.heap[0][1], 0))
+        while frontier and len(plan) < k:
+            priority, number, position = heapq.heappop(frontier)
+            key = self.heap[position][-1]
+            # An entry we threw away still has children to look at
+            if key is not None:
+                plan.append(self.describe(key))
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(self.heap):
+                    entry = self.heap[child]
+                    heapq.heappush(frontier, (entry[0], entry[1], child))
+        return plan
+
+    def describe(self, key):
+        ''' (ReorderPlanner, tuple) -> dict
+
+        Return what top says about the record key (name, colour).
+        '''
+        category, quantity = self.records[key]
+        threshold, target = self.rule(key)
+        return {"name": key[0], "colour": key[1], "category": category,
+                "quantity": quantity, "threshold": threshold,
+                "target": target, "order": target - quantity,
+                "days_of_cover": self.days_of_cover(key)}
+
+
+def check_rule(threshold, target):
+    ''' (int, int) -> NoneType
+
+    Raise a ValueError if threshold and target are not a valid rule.
+    '''
+    if threshold < 0 or target < threshold:
+        raise ValueError("A rule needs 0 <= threshold <= target, not "
+                         + str(threshold) + " and " + str(target))
+
+
+def main(arguments=None):
+    ''' (list) -> NoneType
+
+    Print what to order from the command line.
+    '''
+    parser = argparse.ArgumentParser(description="What the store should "
+                                                 "order.")
+    parser.add_argument("--file", default=store.FILE_NAME,
+                        help="the store's csv file")
+    parser.add_argument("--by", choices=["shortfall", "cover"],
+                        default="shortfall",
+                        help="what makes an item more urgent")
+    parser.add_argument("--top", type=int, default=10,
+                        help="how many items to print")
+    parser.add_argument("--feed", action="store_true",
+                        help="use the store's feed for the purchase history")
+    options = parser.parse_args(arguments)
+    store.FILE_NAME = options.file
+    store.FEED_MODE = options.feed
+    planner = ReorderPlanner(None, options.by)
+    for line in planner.top(options.top):
+        print('{:12}{:12}{:>8}{:>8}'.format(line["colour"], line["name"],
+                                            line["quantity"], line["order"]))
+    planner.close()
+
+
+if __name__ == "__main__":
+    main()
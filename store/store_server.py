@@ -0,0 +1,326 @@
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import random
+import time
+
+import store
+
+HOST = "127.0.0.1"
+PORT = 8765
+
+# Questions can be answered straight away, by any connection, at any time
+READS = ["price", "quantity", "colours", "items", "low_stock", "totals",
+         "quote"]
+# Changes wait in line for the one task that is allowed to make them
+WRITES = ["purchase", "update_price", "checkout"]
+
+
+class StoreServer:
+    ''' A small network service in front of the store.
+
+    Every request is one line of JSON, for example
+        {"op": "price", "item": "pants", "colour": "grey"}
+    and every answer is one line of JSON, either
+        {"ok": true, "result": 70}
+    or
+        {"ok": false, "error": "..."}
+
+    Questions are answered from the store's inventory in memory as soon as
+    they arrive. Changes are put in a queue and made one at a time by a
+    single writer task, so two changes never run at the same time. The
+    writer task makes every change in a thread of its own, so writing the
+    file doesn't stop the questions from being answered meanwhile. This
+    means a question can see a change (or part of a checkout) a moment
+    before it is written, or even a checkout that then fails and is undone.
+    '''
+
+    def __init__(self):
+        ''' (StoreServer) -> NoneType
+
+        Create a server for the store's inventory.
+        '''
+        self.queue = None
+        self.writer_task = None
+        # The one thread every change is made in
+        self.executor = None
+        # True while a change is being made, and the inventory it is made on
+        self.writing = False
+        self.inventory = None
+
+    async def start(self, host=HOST, port=PORT):
+        ''' (StoreServer, str, int) -> asyncio.base_events.Server
+
+        Load the inventory, start the writer task and start listening for
+        connections on host and port.
+        '''
+        # Load the inventory now rather than on the first request
+        store.get_inventory()
+        self.queue = asyncio.Queue()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.writer_task = asyncio.create_task(self.writer())
+        return await asyncio.start_server(self.serve_client, host, port)
+
+    async def stop(self):
+        ''' (StoreServer) -> NoneType
+
+        Stop the writer task.
+        '''
+        self.writer_task.cancel()
+        try:
+            await self.writer_task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown()
+
+    async def serve_client(self, reader, writer):
+        ''' (StoreServer, asyncio.StreamReader, asyncio.StreamWriter)
+            -> NoneType
+
+        Answer every request a client sends until it disconnects.
+        '''
+        try:
+            while True:
+                line = await reader.readline()
+                # An empty line means the client is gone
+                if not line:
+                    break
+                answer = await self.answer(line)
+                writer.write(json.dumps(answer).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def answer(self, line):
+        ''' (StoreServer, bytes) -> dict
+
+        Return the answer to a request line.
+        '''
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("A request is a JSON object, like "
+                                 '{"op": "price", ...}')
+            operation = request.get("op")
+            if operation in READS:
+                result = self.read(request)
+            elif operation in WRITES:
+                # Wait in line for the writer task
+                done = asyncio.get_running_loop().create_future()
+                await self.queue.put((request, done))
+                result = await done
+            else:
+                raise ValueError("Unknown operation " + repr(operation))
+        except Exception as error:
+            # Whatever is wrong with a request, its client gets an answer
+            return {"ok": False, "error": str(error)}
+        return {"ok": True, "result": result}
+
+    def read(self, request):
+        ''' (StoreServer, dict) -> object
+
+        Answer a question (an operation in READS).
+        '''
+        # While a change is being made, the inventory must not be loaded
+        # again from under it: its file can look changed for a moment
+        if self.writing:
+            inventory = self.inventory
+        else:
+            inventory = store.get_inventory()
+            self.inventory = inventory
+        operation = request["op"]
+        if operation == "price":
+            return inventory.get_price(request["item"], request["colour"])
+        if operation == "quantity":
+            return inventory.get_quantity(request["item"], request["colour"])
+        if operation == "colours":
+            return inventory.colours_of_item(request["item"])
+        if operation == "items":
+            return inventory.items_of_colour(request["colour"])
+        if operation == "low_stock":
+            return inventory.low_stock(request.get("min_stock",
+                                                   store.MIN_STOCK))
+        if operation == "totals":
+            return inventory.totals(request.get("min_stock", store.MIN_STOCK))
+        if operation == "quote":
+            # Loading the inventory here could take a while, and would stop
+            # every other connection meanwhile
+            return store.quote(request["cart"], inventory)
+
+    def write(self, request):
+        ''' (StoreServer, dict) -> object
+
+        Make a change (an operation in WRITES). A purchase or a new price is
+        made in a batch of its own, so a purchase of more items than are in
+        stock is not kept (see store.Inventory.batch).
+        '''
+        inventory = store.get_inventory()
+        operation = request["op"]
+        if operation == "purchase":
+            quantity = whole_number(request["quantity"], "quantity")
+            with inventory.batch():
+                return inventory.purchase(request["item"], request["colour"],
+                                          quantity)
+        if operation == "update_price":
+            price = whole_number(request["price"], "price")
+            with inventory.batch():
+                return inventory.set_price(request["item"], request["colour"],
+                                           price)
+        if operation == "checkout":
+            return store.checkout(request["cart"], int(request["budget"]))
+
+    async def writer(self):
+        ''' (StoreServer) -> NoneType
+
+        Make the changes in the queue, one at a time, forever.
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            request, done = await self.queue.get()
+            self.inventory = store.get_inventory()
+            self.writing = True
+            try:
+                result = await loop.run_in_executor(self.executor, self.write,
+                                                    request)
+            except Exception as error:
+                # A bad change must not stop the writer task, or every
+                # change after it would wait forever
+                if not done.done():
+                    done.set_exception(error)
+            else:
+                if not done.done():
+                    done.set_result(result)
+            finally:
+                self.writing = False
+
+
+def whole_number(value, name):
+    ''' (object, str) -> int
+
+    Return value as an int, or raise a ValueError if it is not a whole
+    number greater than 0 (name says what it is).
+    '''
+    # A number like 2.5 is not a number of items (or dollars) either
+    if isinstance(value, float):
+        raise ValueError("The " + name + " has to be a whole number, not "
+                         + repr(value))
+    number = int(value)
+    if number <= 0:
+        raise ValueError("The " + name + " has to be greater than 0, not "
+                         + repr(value))
+    return number
+
+
+async def serve(host=HOST, port=PORT):
+    ''' (str, int) -> NoneType
+
+    Run the store server until it is stopped.
+    '''
+    server = StoreServer()
+    listener = await server.start(host, port)
+    print("Serving the store on " + host + ":" + str(port))
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await server.stop()
+
+
+async def client(host, port, requests, latencies):
+    ''' (str, int, list, list) -> NoneType
+
+    Open one connection, send every request one after the other and add the
+    time each answer took (in milliseconds) to latencies.
+    '''
+    reader, writer = await asyncio.open_connection(host, port)
+    for request in requests:
+        before = time.perf_counter()
+        writer.write(json.dumps(request).encode() + b"\n")
+        await writer.drain()
+        await reader.readline()
+        latencies.append((time.perf_counter() - before) * 1000)
+    writer.close()
+    await writer.wait_closed()
+
+
+def make_requests(keys, count, write_ratio, generator):
+    ''' (list, int, float, random.Random) -> list
+
+    Return count random requests about the records in keys, where about
+    write_ratio of them are purchases and the rest are price questions.
+    '''
+    requests = []
+    for number in range(count):
+        item, colour = generator.choice(keys)
+        if generator.random() < write_ratio:
+            requests.append({"op": "purchase", "item": item, "colour": colour,
+                             "quantity": 1})
+        else:
+            requests.append({"op": "price", "item": item, "colour": colour})
+    return requests
+
+
+async def load_test(host=HOST, port=PORT, connections=10, requests=1000,
+                    write_ratio=0.1, seed=0):
+    ''' (str, int, int, int, float, int) -> dict
+
+    Send requests requests from every one of connections clients at the same
+    time, and return how many requests per second the server answered and
+    its latency percentiles.
+    '''
+    generator = random.Random(seed)
+    # Ask about records that really exist
+    keys = [record.key() for record in store.get_inventory().rows()]
+    latencies = []
+    clients = [client(host, port,
+                      make_requests(keys, requests, write_ratio, generator),
+                      latencies)
+               for number in range(connections)]
+    started = time.perf_counter()
+    await asyncio.gather(*clients)
+    total = time.perf_counter() - started
+    latencies.sort()
+    return {"requests": len(latencies),
+            "requests_per_s": len(latencies) / total,
+            "p50_ms": latencies[len(latencies) // 2],
+            "p99_ms": latencies[min(len(latencies) - 1,
+                                    len(latencies) * 99 // 100)]}
+
+
+def main(arguments=None):
+    ''' (list) -> NoneType
+
+    Run the server, or the load test against it, from the command line.
+    '''
+    parser = argparse.ArgumentParser(description="The store as a service.")
+    parser.add_argument("command", choices=["serve", "load"])
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--journal", action="store_true",
+                        help="use the store's journal mode")
+    parser.add_argument("--connections", type=int, default=10,
+                        help="(load) how many clients to run at once")
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="(load) how many requests every client sends")
+    parser.add_argument("--write-ratio", type=float, default=0.1,
+                        help="(load) how many requests are purchases")
+    options = parser.parse_args(arguments)
+    store.JOURNAL_MODE = options.journal
+    if options.command == "serve":
+        try:
+            asyncio.run(serve(options.host, options.port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        result = asyncio.run(load_test(options.host, options.port,
+                                       options.connections, options.requests,
+                                       options.write_ratio))
+        for name, value in result.items():
+            print('{:16}'.format(name) + str(round(value, 3)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,533 @@
+import bisect
+import contextlib
+import heapq
+import json
+import os
+import re
+import zlib
+
+import store
+
+# The manifest is kept next to the csv file
+MANIFEST_NAME = "store_items.shards.json"
+# How many shards to split the store into when sharding by hash, unless we
+# are told otherwise
+SHARDS = 8
+
+
+class ShardedInventory:
+    ''' The store's database, split into many csv files (shards).
+
+    A small JSON manifest says how the records are split and which file has
+    which shard:
+     - "by": "category" puts every category in its own file
+     - "by": "hash" puts every record in one of "shards" files, picked from
+       its name and colour (see shard_number)
+    Every shard is a store.Inventory of its own, so a change only rewrites
+    (and locks) the one file it is about, and questions about everything,
+    like low_stock, ask every shard and merge their answers.
+
+    It has the same methods as store.Inventory, so it can be plugged into the
+    store with store.use_inventory.
+    '''
+
+    def __init__(self, manifest_name=None, journal=False, locking=False,
+                 in_place=False):
+        ''' (ShardedInventory, str, bool, bool, bool) -> NoneType
+
+        Open the shards listed in the manifest manifest_name (MANIFEST_NAME if
+        no manifest_name is given). journal, locking and in_place are the
+        modes of every shard (see store.Inventory).
+
+        REQ: the manifest exists (see shard_csv)
+        '''
+        if manifest_name is None:
+            manifest_name = MANIFEST_NAME
+        self.file_name = manifest_name
+        self.journal = journal
+        self.locking = locking
+        self.in_place = in_place
+        # shard name -> store.Inventory
+        self.shards = {}
+        # (name, colour) -> shard name, so we know where every record is
+        self.shard_of = {}
+        # While a batch is open, the shards that were changed in it, and
+        # the batches of every shard
+        self.pending = None
+        self.batches = None
+        # What the manifest looked like when we last read or wrote it
+        self.signature = None
+        self.load()
+
+    def load(self):
+        ''' (ShardedInventory) -> NoneType
+
+        Read the manifest again and (re)load every shard that changed.
+        '''
+        self.signature = store.file_signature(self.file_name)
+        manifest = read_manifest(self.file_name)
+        self.header = manifest["header"]
+        self.by = manifest["by"]
+        self.shard_count = manifest.get("shards", len(manifest["files"]))
+        self.files = manifest["files"]
+        folder = os.path.dirname(self.file_name)
+        shards = {}
+        for name, file_name in self.files.items():
+            shard = self.shards.get(name)
+            if shard is None:
+                shard = store.Inventory(os.path.join(folder, file_name),
+                                        self.journal, self.locking,
+                                        self.in_place)
+                shard.feed_file = self.file_name
+            elif shard.is_stale():
+                shard.load()
+            shards[name] = shard
+        self.shards = shards
+        self.find_records()
+
+    def find_records(self):
+        ''' (ShardedInventory) -> NoneType
+
+        Find again which shard every record is in.
+        '''
+        self.shard_of = {}
+        for name, shard in self.shards.items():
+            for key in shard.records:
+                self.shard_of[key] = name
+
+    def is_stale(self):
+        ''' (ShardedInventory) -> bool
+
+        Return True if somebody else changed the manifest or any shard since
+        we last read or wrote them.
+        '''
+        if store.file_signature(self.file_name) != self.signature:
+            return True
+        return any(shard.is_stale() for shard in self.shards.values())
+
+    def compact(self):
+        ''' (ShardedInventory) -> NoneType
+
+        Fold the log of every shard back into its csv file.
+        '''
+        for shard in self.shards.values():
+            shard.compact()
+
+    def shard_name(self, category, name, colour):
+        ''' (ShardedInventory, str, str, str) -> str
+
+        Return the name of the shard a record belongs in.
+        '''
+        if self.by == "category":
+            return category
+        return str(shard_number(name, colour, self.shard_count))
+
+    def shard(self, shard_name):
+        ''' (ShardedInventory, str) -> store.Inventory
+
+        Return the shard called shard_name, creating its file (and adding it
+        to the manifest) if it doesn't exist yet.
+        '''
+        if shard_name not in self.shards:
+            folder = os.path.dirname(self.file_name)
+            # In locking mode, only one program at a time changes the manifest
+            lock = contextlib.nullcontext()
+            if self.locking:
+                lock = store.file_lock(self.file_name)
+            with lock:
+                # Somebody else may have made the shard in the meantime
+                self.files = read_manifest(self.file_name)["files"]
+                if shard_name not in self.files:
+                    file_name = new_shard_file(self.file_name, shard_name,
+                                               self.files)
+                    store._write_rows(os.path.join(folder, file_name),
+                                      self.header, [])
+                    self.files[shard_name] = file_name
+                    write_manifest(self.file_name, self.header, self.by,
+                                   self.shard_count, self.files)
+            self.signature = store.file_signature(self.file_name)
+            shard = store.Inventory(
+                os.path.join(folder, self.files[shard_name]),
+                self.journal, self.locking, self.in_place)
+            shard.feed_file = self.file_name
+            # A shard made in the middle of a batch is part of the batch
+            if self.batches is not None:
+                self.batches.enter_context(shard.batch())
+            self.shards[shard_name] = shard
+        return self.shards[shard_name]
+
+    def find(self, item, colour):
+        ''' (ShardedInventory, str, str) -> store.Inventory
+
+        Return the shard that has the record for the item and its colour, or
+        None if there is no such record.
+        '''
+        shard_name = self.shard_of.get((item, colour))
+        if shard_name is None:
+            return None
+        return self.shards[shard_name]
+
+    def change(self, shard, change):
+        ''' (ShardedInventory, store.Inventory, list) -> bool
+
+        Make the change in the shard (see store.Inventory.change). Return
+        True if the record was found.
+        '''
+        if self.pending is not None:
+            self.pending[id(shard)] = shard
+        return shard.change(change)
+
+    def rows(self):
+        ''' (ShardedInventory) -> list
+
+        Return every record, sorted by category (the order used in the file).
+        '''
+        # Every shard is already sorted by category, so we only merge them
+        return list(heapq.merge(*[shard.order
+                                  for shard in self.shards.values()],
+                                key=lambda k: k.category))
+
+    def get_record(self, item, colour):
+        ''' (ShardedInventory, str, str) -> store.StoreItem
+
+        Return the record for the item and its colour, or None if there is
+        no such record.
+        '''
+        shard = self.find(item, colour)
+        if shard is not None:
+            return shard.get_record(item, colour)
+
+    def get_price(self, item, colour):
+        ''' (ShardedInventory, str, str) -> int
+
+        Return the price of the item and its colour, or None if there is
+        no such record.
+        '''
+        record = self.get_record(item, colour)
+        if record is not None:
+            return record.price
+
+    def get_quantity(self, item, colour):
+        ''' (ShardedInventory, str, str) -> int
+
+        Return how many of the item and its colour are in stock, or None if
+        there is no such record.
+        '''
+        record = self.get_record(item, colour)
+        if record is not None:
+            return record.quantity
+
+    def add(self, category, name, colour, price, quantity):
+        ''' (ShardedInventory, str, str, str, int, int) -> NoneType
+
+        Add a new record to its shard. If the record already exists, it is
+        replaced (and taken out of its old shard if it moves).
+        '''
+        shard_name = self.shard_name(category, name, colour)
+        old_shard = self.shard_of.get((name, colour))
+        if old_shard is not None and old_shard != shard_name:
+            self.change(self.shards[old_shard], ["remove", name, colour])
+        self.change(self.shard(shard_name),
+                    ["add", category, name, colour, price, quantity])
+        self.shard_of[(name, colour)] = shard_name
+
+    def add_many(self, records):
+        ''' (ShardedInventory, list) -> NoneType
+
+        Add every record (a store.StoreItem) in the list, replacing the
+        records that already exist, writing every shard only once.
+        '''
+        with self.batch():
+            for record in records:
+                self.add(record.category, record.name, record.colour,
+                         record.price, record.quantity)
+
+    def remove(self, item, colour):
+        ''' (ShardedInventory, str, str) -> bool
+
+        Remove the record for the item and its colour. Return True if the
+        record was found.
+        '''
+        shard = self.find(item, colour)
+        if shard is None:
+            return False
+        del self.shard_of[(item, colour)]
+        return self.change(shard, ["remove", item, colour])
+
+    def set_price(self, item, colour, new_price):
+        ''' (ShardedInventory, str, str, int) -> bool
+
+        Replace the price of the item and its colour with new_price. Return
+        True if the record was found.
+        '''
+        shard = self.find(item, colour)
+        if shard is None:
+            return False
+        return self.change(shard, ["price", item, colour, new_price])
+
+    def purchase(self, item, colour, items_bought):
+        ''' (ShardedInventory, str, str, int) -> bool
+
+        Take items_bought out of the stock of the item and its colour. Return
+        True if the record was found.
+        '''
+        shard = self.find(item, colour)
+        if shard is None:
+            return False
+        return self.change(shard, ["purchase", item, colour, items_bought])
+
+    def in_order(self, keys_of):
+        ''' (ShardedInventory, function) -> list
+
+        Return the records of the keys (name, colour) keys_of gives for every
+        shard, in the order of rows.
+        '''
+        # Every shard gives its records in its own order, and we merge them
+        # the same way rows does
+        return list(heapq.merge(*[shard.in_order(keys_of(shard))
+                                  for shard in self.shards.values()],
+                                key=lambda k: k.category))
+
+    def items_of_colour(self, colour):
+        ''' (ShardedInventory, str) -> list
+
+        Return the names of all the items that are that colour.
+        '''
+        return [record.name for record in self.in_order(
+            lambda shard: [(name, colour)
+                           for name in shard.by_colour.get(colour, ())])]
+
+    def colours_of_item(self, item):
+        ''' (ShardedInventory, str) -> list
+
+        Return all the colours of the item.
+        '''
+        return [record.colour for record in self.in_order(
+            lambda shard: [(item, colour)
+                           for colour in shard.by_name.get(item, ())])]
+
+    def items_in_category(self, category):
+        ''' (ShardedInventory, str) -> list
+
+        Return (a copy of) every record in the category.
+        '''
+        # A category has a shard of its own, or is spread over all of them
+        if self.by == "category":
+            if category not in self.shards:
+                return []
+            return self.shards[category].items_in_category(category)
+        records = []
+        for shard in self.shards.values():
+            records.extend(shard.items_in_category(category))
+        return records
+
+    def low_stock(self, min_stock):
+        ''' (ShardedInventory, int) -> list
+
+        Return "colour name" for every record with less than min_stock items,
+        in the order of rows.
+        '''
+        def low_keys(shard):
+            # Everything before the first record with min_stock items is low
+            end = bisect.bisect_left(shard.by_quantity, (min_stock,))
+            return [(name, colour)
+                    for quantity, name, colour in shard.by_quantity[:end]]
+        return [record.colour + " " + record.name
+                for record in self.in_order(low_keys)]
+
+    def totals(self, min_stock):
+        ''' (ShardedInventory, int) -> dict
+
+        Return the totals of the records (see store.count_totals) and how
+        many records have less than min_stock items ("low_stock").
+        '''
+        # Every shard keeps its own totals, so we only add them up
+        totals = store.new_totals()
+        totals["low_stock"] = 0
+        for shard in self.shards.values():
+            shard_totals = shard.totals(min_stock)
+            for name in ("records", "units", "value", "low_stock"):
+                totals[name] += shard_totals[name]
+            for group in ("categories", "colours"):
+                for key, total in shard_totals[group].items():
+                    group_total = totals[group].setdefault(
+                        key, {"records": 0, "units": 0, "value": 0})
+                    for name in ("records", "units", "value"):
+                        group_total[name] += total[name]
+        return totals
+
+    @contextlib.contextmanager
+    def batch(self):
+        ''' (ShardedInventory) -> context manager
+
+        Group many changes so they are checked together and every shard is
+        written only once, when the with block ends (see
+        store.Inventory.batch).
+
+        Every change is checked before any shard is written, so a change that
+        leaves a record with a negative quantity or a price that is not
+        greater than 0 keeps all of the changes from being made. Each shard
+        is then written on its own: the batch is all or nothing in every
+        shard, but a crash in the middle could write some shards and not
+        others.
+        '''
+        # A batch inside a batch is just part of the outer one
+        if self.pending is not None:
+            yield self
+            return
+        self.pending = {}
+        try:
+            with contextlib.ExitStack() as batches:
+                # Start a batch in every shard, so every change waits in its
+                # shard. Leaving the with block ends them all (and if there
+                # was an error, they all throw their changes away).
+                self.batches = batches
+                for shard in list(self.shards.values()):
+                    batches.enter_context(shard.batch())
+                yield self
+                # Check everything before the first shard is written
+                for shard in self.pending.values():
+                    shard.check(shard.pending)
+        except BaseException:
+            # Records that moved went back where they were
+            self.find_records()
+            raise
+        finally:
+            self.pending = None
+            self.batches = None
+
+
+def shard_number(name, colour, shards):
+    ''' (str, str, int) -> int
+
+    Return the number (0 to shards - 1) of the shard the record with this
+    name and colour belongs in. Unlike hash(), crc32 gives the same number in
+    every program.
+    '''
+    return zlib.crc32((name + "\0" + colour).encode("utf-8")) % shards
+
+
+def read_manifest(manifest_name):
+    ''' (str) -> dict
+
+    Return what the manifest manifest_name has in it.
+    '''
+    with open(manifest_name) as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(manifest_name, header, by, shards, files):
+    ''' (str, list, str, int, dict) -> NoneType
+
+    Write the manifest manifest_name. files is shard name -> file name, where
+    file names are relative to the manifest's folder.
+    '''
+    temp_file_name = store.temp_name(manifest_name)
+    with open(temp_file_name, 'w') as manifest_file:
+        json.dump({"header": header, "by": by, "shards": shards,
+                   "files": files}, manifest_file, indent=2)
+    # Like the csv files, the manifest is only replaced once it is complete
+    os.replace(temp_file_name, manifest_name)
+
+
+def new_shard_file(manifest_name, shard_name, files):
+    ''' (str, str, dict) -> str
+
+    Return a file name, not used by any of files yet, for the shard called
+    shard_name (store_items.shards.json and "office" ->
+    store_items.office.csv).
+    '''
+    base = os.path.basename(manifest_name)
+    if base.endswith(".shards.json"):
+        base = base[:-len(".shards.json")]
+    # Only keep letters, digits, "-" and "_" of the shard's name
+    safe_name = re.sub(r"[^A-Za-z0-9_-]", "_", shard_name) or "_"
+    file_name = base + "." + safe_name + ".csv"
+    number = 1
+    while file_name in files.values():
+        number += 1
+        file_name = base + "." + safe_name + "-" + str(number) + ".csv"
+    return file_name
+
+
+def shard_csv(csv_name=None, manifest_name=None, by="category", shards=None):
+    ''' (str, str, str, int) -> int
+
+    Split the csv file csv_name (store.FILE_NAME if no csv_name is given)
+    into shard files next to the manifest manifest_name (MANIFEST_NAME if no
+    manifest_name is given), by category or by hash (into shards files,
+    SHARDS if no shards is given), and write the manifest. Return how many
+    shards were written. The changes still waiting in the log of csv_name
+    (see store.compact) are folded into it first, so the shards have them
+    and no log is left behind.
+
+    REQ: csv_name has to be a valid .csv file with a header
+    REQ: by is "category" or "hash"
+    '''
+    if by not in ("category", "hash"):
+        raise ValueError("Shards are made by category or by hash")
+    if csv_name is None:
+        csv_name = store.FILE_NAME
+    if manifest_name is None:
+        manifest_name = MANIFEST_NAME
+    if shards is None:
+        shards = SHARDS
+    if os.path.exists(store.journal_name(csv_name)):
+        store.Inventory(csv_name, True, store.LOCKING_MODE).compact()
+    header, database = store.read_csv(csv_name)
+    # The file is sorted by category, so every shard will be too
+    rows_of = {}
+    for record in database:
+        if by == "category":
+            shard_name = record.category
+        else:
+            shard_name = str(shard_number(record.name, record.colour, shards))
+        rows_of.setdefault(shard_name, []).append(record)
+    files = {}
+    folder = os.path.dirname(manifest_name)
+    for shard_name, rows in rows_of.items():
+        file_name = new_shard_file(manifest_name, shard_name, files)
+        store._write_rows(os.path.join(folder, file_name), header, rows)
+        files[shard_name] = file_name
+    write_manifest(manifest_name, header, by, shards, files)
+    return len(files)
+
+
+def merge_shards(csv_name=None, manifest_name=None):
+    ''' (str, str) -> int
+
+    Write every record of the shards listed in the manifest manifest_name
+    (MANIFEST_NAME if no manifest_name is given) back into the single csv
+    file csv_name (store.FILE_NAME if no csv_name is given), sorted by
+    category. Return how many records were written.
+    '''
+    if csv_name is None:
+        csv_name = store.FILE_NAME
+    inventory = ShardedInventory(manifest_name)
+    rows = inventory.rows()
+    store._write_rows(csv_name, inventory.header, rows)
+    # The shards have every change, so a log left next to the csv file is
+    # out of date and must not be applied to it
+    log_name = store.journal_name(csv_name)
+    if os.path.exists(log_name):
+        os.remove(log_name)
+    return len(rows)
+
+
+def use_sharded(manifest_name=None, by="category", shards=None):
+    ''' (str, str, int) -> ShardedInventory
+
+    Make every function of the store use the shards listed in the manifest
+    manifest_name (MANIFEST_NAME if no manifest_name is given), in the
+    store's current JOURNAL_MODE, LOCKING_MODE and IN_PLACE_MODE. If the
+    manifest does not exist yet, the store's csv file is split first (see
+    shard_csv). Return the ShardedInventory.
+    '''
+    if manifest_name is None:
+        manifest_name = MANIFEST_NAME
+    if not os.path.exists(manifest_name):
+        shard_csv(None, manifest_name, by, shards)
+    inventory = ShardedInventory(manifest_name, store.JOURNAL_MODE,
+                                 store.LOCKING_MODE, store.IN_PLACE_MODE)
+    store.use_inventory(inventory)
+    return inventory
@@ -0,0 +1,396 @@
+import contextlib
+import os
+import sqlite3
+
+import store
+
+# The database is kept next to the csv file
+DB_NAME = "store_items.db"
+
+# One row per record. Finding a record by name and colour, by colour, by
+# category or by quantity all use an index instead of reading every row.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS items (
+    category TEXT NOT NULL,
+    name TEXT NOT NULL,
+    colour TEXT NOT NULL,
+    price INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    UNIQUE (name, colour)
+);
+CREATE INDEX IF NOT EXISTS items_by_colour ON items (colour);
+CREATE INDEX IF NOT EXISTS items_by_category ON items (category);
+CREATE INDEX IF NOT EXISTS items_by_quantity ON items (quantity, name, colour);
+CREATE TABLE IF NOT EXISTS header (
+    position INTEGER PRIMARY KEY,
+    column TEXT NOT NULL
+);
+'''
+
+
+class SqliteInventory:
+    ''' The store's database, kept in a SQLite file.
+
+    It has the same methods as store.Inventory, so it can be plugged into the
+    store with store.use_inventory. Every lookup and change only touches the
+    rows it needs, instead of reading or writing the whole csv file.
+    '''
+
+    def __init__(self, db_name=None):
+        ''' (SqliteInventory, str) -> NoneType
+
+        Open (or create) the SQLite database db_name (DB_NAME if no db_name
+        is given).
+        '''
+        if db_name is None:
+            db_name = DB_NAME
+        self.file_name = db_name
+        # We start and end transactions ourselves (see batch). The store's
+        # service makes its changes in another thread than the one that
+        # answers the questions (see store_server.py), so the connection
+        # has to work from any thread.
+        self.connection = sqlite3.connect(db_name, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        # While a batch is open, the (name, colour) of every changed record
+        # waits here to be checked, and the events of the changes wait to be
+        # published (see store.publish)
+        self.pending = None
+        self.events = []
+        self.load()
+
+    def load(self):
+        ''' (SqliteInventory) -> NoneType
+
+        Read the header again.
+        '''
+        self.header = [row[0] for row in self.connection.execute(
+            "SELECT column FROM header ORDER BY position")]
+
+    def is_stale(self):
+        ''' (SqliteInventory) -> bool
+
+        Return False, SQLite always gives back the latest data.
+        '''
+        return False
+
+    def compact(self):
+        ''' (SqliteInventory) -> NoneType
+
+        Give the space of deleted rows back to the file system.
+        '''
+        self.connection.execute("VACUUM")
+
+    def close(self):
+        ''' (SqliteInventory) -> NoneType
+
+        Close the database.
+        '''
+        self.connection.close()
+
+    def rows(self):
+        ''' (SqliteInventory) -> list
+
+        Return every record, sorted by category (the order used in the file).
+        '''
+        return [store.StoreItem(*row) for row in self.connection.execute(
+            "SELECT category, name, colour, price, quantity FROM items "
+            "ORDER BY category, rowid")]
+
+    def get_record(self, item, colour):
+        ''' (SqliteInventory, str, str) -> store.StoreItem
+
+        Return the record for the item and its colour, or None if there is
+        no such record.
+        '''
+        row = self.connection.execute(
+            "SELECT category, name, colour, price, quantity FROM items "
+            "WHERE name = ? AND colour = ?", (item, colour)).fetchone()
+        if row is not None:
+            return store.StoreItem(*row)
+
+    def get_price(self, item, colour):
+        ''' (SqliteInventory, str, str) -> int
+
+        Return the price of the item and its colour, or None if there is
+        no such record.
+        '''
+        record = self.get_record(item, colour)
+        if record is not None:
+            return record.price
+
+    def get_quantity(self, item, colour):
+        ''' (SqliteInventory, str, str) -> int
+
+        Return how many of the item and its colour are in stock, or None if
+        there is no such record.
+        '''
+        record = self.get_record(item, colour)
+        if record is not None:
+            return record.quantity
+
+    def items_of_colour(self, colour):
+        ''' (SqliteInventory, str) -> list
+
+        Return the names of all the items that are that colour.
+        '''
+        return [row[0] for row in self.connection.execute(
+            "SELECT name FROM items WHERE colour = ? "
+            "ORDER BY category, rowid",
+            (colour,))]
+
+    def colours_of_item(self, item):
+        ''' (SqliteInventory, str) -> list
+
+        Return all the colours of the item.
+        '''
+        return [row[0] for row in self.connection.execute(
+            "SELECT colour FROM items WHERE name = ? "
+            "ORDER BY category, rowid",
+            (item,))]
+
+    def items_in_category(self, category):
+        ''' (SqliteInventory, str) -> list
+
+        Return every record in the category.
+        '''
+        return [store.StoreItem(*row) for row in self.connection.execute(
+            "SELECT category, name, colour, price, quantity FROM items "
+            "WHERE category = ? ORDER BY rowid", (category,))]
+
+    def low_stock(self, min_stock):
+        ''' (SqliteInventory, int) -> list
+
+        Return "colour name" for every record with less than min_stock items,
+        in the order of the file (see rows).
+        '''
+        return [colour + " " + name for name, colour in self.connection.execute(
+            "SELECT name, colour FROM items WHERE quantity < ? "
+            "ORDER BY category, rowid", (min_stock,))]
+
+    def totals(self, min_stock):
+        ''' (SqliteInventory, int) -> dict
+
+        Return the totals of the records (see store.count_totals) and how
+        many records have less than min_stock items ("low_stock").
+        '''
+        # The database adds everything up itself
+        sums = "COUNT(*), COALESCE(SUM(quantity), 0), " \
+               "COALESCE(SUM(price * quantity), 0)"
+        totals = dict(zip(("records", "units", "value"),
+                          self.connection.execute(
+                              "SELECT " + sums + " FROM items").fetchone()))
+        for group, column in (("categories", "category"),
+                              ("colours", "colour")):
+            totals[group] = {
+                row[0]: dict(zip(("records", "units", "value"), row[1:]))
+                for row in self.connection.execute(
+                    "SELECT " + column + ", " + sums + " FROM items "
+                    "GROUP BY " + column + " ORDER BY MIN(rowid)")}
+        totals["low_stock"] = self.connection.execute(
+            "SELECT COUNT(*) FROM items WHERE quantity < ?",
+            (min_stock,)).fetchone()[0]
+        return totals
+
+    def run(self, change, sql, parameters, first=None):
+        ''' (SqliteInventory, list, str, tuple, tuple) -> bool
+
+        Run one statement that makes the change (see store.Inventory.apply).
+        If first is given, it is another (sql, parameters) that is run just
+        before, and either both statements are kept or neither is. Return True
+        if the record was found.
+        '''
+        key = store.change_key(change)
+        events = store.feed_enabled()
+        if events:
+            old_record = self.get_record(key[0], key[1])
+        if first is None:
+            found = self.connection.execute(sql, parameters).rowcount > 0
+        else:
+            # A savepoint works both inside and outside a batch
+            self.connection.execute("SAVEPOINT change")
+            try:
+                self.connection.execute(*first)
+                found = self.connection.execute(sql, parameters).rowcount > 0
+            except BaseException:
+                self.connection.execute("ROLLBACK TO change")
+                self.connection.execute("RELEASE change")
+                raise
+            self.connection.execute("RELEASE change")
+        if found and events:
+            event = store.make_event(change, old_record,
+                                     self.get_record(key[0], key[1]))
+            # Inside a batch, the event waits for the end of the batch
+            if self.pending is not None:
+                self.events.append(event)
+            else:
+                store.publish(self.file_name, [event])
+        # Inside a batch, remember which records we need to check
+        if found and self.pending is not None:
+            self.pending.add(key)
+        return found
+
+    def add(self, category, name, colour, price, quantity):
+        ''' (SqliteInventory, str, str, str, int, int) -> NoneType
+
+        Add a new record. If the record already exists, it is replaced.
+        '''
+        # Like in store.Inventory, a record that is replaced keeps its place
+        # (its rowid), unless it moves to another category: then it goes
+        # after the other records of that category, as a new record
+        self.run(["add", category, name, colour, price, quantity],
+                 "INSERT INTO items VALUES (?, ?, ?, ?, ?) "
+                 "ON CONFLICT (name, colour) DO UPDATE SET "
+                 "price = excluded.price, quantity = excluded.quantity",
+                 (category, name, colour, int(price), int(quantity)),
+                 ("DELETE FROM items "
+                  "WHERE name = ? AND colour = ? AND category != ?",
+                  (name, colour, category)))
+
+    def add_many(self, records):
+        ''' (SqliteInventory, list) -> NoneType
+
+        Add every record (a store.StoreItem) in the list, replacing the
+        records that already exist, in one transaction.
+        '''
+        with self.batch():
+            for record in records:
+                self.add(record.category, record.name, record.colour,
+                         record.price, record.quantity)
+
+    def remove(self, item, colour):
+        ''' (SqliteInventory, str, str) -> bool
+
+        Remove the record for the item and its colour. Return True if the
+        record was found.
+        '''
+        return self.run(["remove", item, colour],
+                        "DELETE FROM items WHERE name = ? AND colour = ?",
+                        (item, colour))
+
+    def set_price(self, item, colour, new_price):
+        ''' (SqliteInventory, str, str, int) -> bool
+
+        Replace the price of the item and its colour with new_price. Return
+        True if the record was found.
+        '''
+        return self.run(["price", item, colour, new_price],
+                        "UPDATE items SET price = ? "
+                        "WHERE name = ? AND colour = ?",
+                        (int(new_price), item, colour))
+
+    def purchase(self, item, colour, items_bought):
+        ''' (SqliteInventory, str, str, int) -> bool
+
+        Take items_bought out of the stock of the item and its colour. Return
+        True if the record was found.
+        '''
+        return self.run(["purchase", item, colour, items_bought],
+                        "UPDATE items SET quantity = quantity - ? "
+                        "WHERE name = ? AND colour = ?",
+                        (int(items_bought), item, colour))
+
+    @contextlib.contextmanager
+    def batch(self):
+        ''' (SqliteInventory) -> context manager
+
+        Group many changes in one transaction (see store.Inventory.batch).
+        If any change leaves a record with a negative quantity or a price
+        that is not greater than 0, or if the with block raises an error,
+        none of the changes are kept and the error is raised.
+        '''
+        # A batch inside a batch is just part of the outer one
+        if self.pending is not None:
+            yield self
+            return
+        self.pending = set()
+        self.events = []
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+            # Only the records that were changed need to be checked
+            for key in self.pending:
+                record = self.get_record(key[0], key[1])
+                if record is not None:
+                    store.check_record(record)
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            self.pending = None
+            self.events = []
+            raise
+        self.pending = None
+        self.connection.execute("COMMIT")
+        events = self.events
+        self.events = []
+        store.publish(self.file_name, events)
+
+
+def import_csv(csv_name=None, db_name=None):
+    ''' (str, str) -> int
+
+    Copy every record of the csv file csv_name (store.FILE_NAME if no csv_name
+    is given) into the database db_name (DB_NAME if no db_name is given),
+    replacing whatever the database had. Return how many records were copied.
+
+    The changes still waiting in the log of csv_name (see store.compact) are
+    copied too.
+
+    REQ: csv_name has to be a valid .csv file with a header
+    '''
+    if csv_name is None:
+        csv_name = store.FILE_NAME
+    if os.path.exists(store.journal_name(csv_name)):
+        # The log has to be applied to the records first, which needs them
+        # all in memory (see store.read_current)
+        header, rows = store.read_current(csv_name)
+    else:
+        rows = store.iter_csv(csv_name)
+        header = next(rows)
+    inventory = SqliteInventory(db_name)
+    with inventory.batch():
+        inventory.connection.execute("DELETE FROM items")
+        inventory.connection.execute("DELETE FROM header")
+        inventory.connection.executemany(
+            "INSERT INTO header VALUES (?, ?)", enumerate(header))
+        # executemany reads the rows one at a time (straight from the file
+        # when there is no log)
+        count = inventory.connection.executemany(
+            "INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)",
+            ((row[0], row[1], row[2], int(row[3]), int(row[4]))
+             for row in rows)).rowcount
+    inventory.close()
+    return count
+
+
+def export_csv(csv_name=None, db_name=None):
+    ''' (str, str) -> int
+
+    Write every record of the database db_name (DB_NAME if no db_name is
+    given) into the csv file csv_name (store.FILE_NAME if no csv_name is
+    given), sorted by category. Return how many records were written.
+    '''
+    if csv_name is None:
+        csv_name = store.FILE_NAME
+    inventory = SqliteInventory(db_name)
+    rows = inventory.rows()
+    # Like the store, never leave a half written csv file behind
+    store._write_rows(csv_name, inventory.header, rows)
+    inventory.close()
+    return len(rows)
+
+
+def use_sqlite(db_name=None):
+    ''' (str) -> SqliteInventory
+
+    Make every function of the store use the database db_name (DB_NAME if no
+    db_name is given). If the database does not exist yet, it is created
+    from the store's csv file first. Return the SqliteInventory.
+    '''
+    inventory = SqliteInventory(db_name)
+    # A brand new database has no header yet
+    if not inventory.header:
+        inventory.close()
+        import_csv(None, db_name)
+        inventory = SqliteInventory(db_name)
+    store.use_inventory(inventory)
+    return inventory